@@ -17,16 +17,33 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this charm.  If not, see <http://www.gnu.org/licenses/>.
 
-# This script runs as a cron job installed by the
-# glance-simplestreams-sync juju charm.  It reads config files that
-# are written by the hooks of that charm based on its config and
-# juju relation to keystone. However, it does not execute in a
+# This script runs as a cron job, or as a systemd service with --daemon,
+# installed by the glance-simplestreams-sync juju charm.  It reads
+# config files that are written by the hooks of that charm based on its
+# config and juju relation to keystone. However, it does not execute in a
 # juju hook context itself.
 
+import argparse
+import atexit
 import base64
+import collections
 import copy
+import errno
+import fcntl
+import functools
+import hashlib
+import json
 import logging
 import os
+import sys
+import time
+
+# (phase, timestamp) pairs, see --print-startup-profile.
+STARTUP_PROFILE = [('start', time.time())]
+
+
+def startup_mark(phase):
+    STARTUP_PROFILE.append((phase, time.time()))
 
 
 def setup_logging():
@@ -52,31 +69,112 @@ def setup_logging():
 
 log = setup_logging()
 
+CONF_FILE_DIR = '/etc/glance-simplestreams-sync'
+PID_FILE_DIR = '/var/run'
+CHARM_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'mirrors.yaml')
+ID_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'identity.yaml')
 
-import atexit
-import fcntl
+SYNC_RUNNING_FLAG_FILE_NAME = os.path.join(PID_FILE_DIR,
+                                           'glance-simplestreams-sync.pid')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and sync on the configured "
+                             "frequency instead of syncing once")
+    parser.add_argument('--print-startup-profile', action='store_true',
+                        help="print the time spent in each startup phase")
+    return parser.parse_args()
+
+
+def print_startup_profile():
+    start = prev = STARTUP_PROFILE[0][1]
+    lines = []
+    for phase, ts in STARTUP_PROFILE[1:]:
+        lines.append("{:<10} {:8.1f} ms (+{:.1f} ms)".format(
+            phase, (ts - start) * 1000, (ts - prev) * 1000))
+        prev = ts
+    log.info("startup profile:\n{}".format('\n'.join(lines)))
+    print('\n'.join(lines))
+
+
+def cleanup():
+    try:
+        os.unlink(SYNC_RUNNING_FLAG_FILE_NAME)
+    except OSError as e:
+        if e.errno != 2:
+            raise e
+
+
+def acquire_sync_lock(args):
+    """Take the sync lock, or exit if another sync holds it.
+
+    This runs before the imports below, so that the cron invocations
+    finding a sync in progress exit without loading keystoneclient, kombu
+    and simplestreams.
+    """
+    # Not opened with 'w', which would truncate the pid of the process
+    # holding the lock.
+    lockfile = open(SYNC_RUNNING_FLAG_FILE_NAME, 'a')
+
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        log.info("{} is locked, exiting".format(SYNC_RUNNING_FLAG_FILE_NAME))
+        startup_mark('lock')
+        if args.print_startup_profile:
+            print_startup_profile()
+        sys.exit(0)
+
+    atexit.register(cleanup)
+    lockfile.truncate(0)
+    lockfile.write(str(os.getpid()))
+    lockfile.flush()
+    startup_mark('lock')
+    return lockfile
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    log.info("glance-simplestreams-sync started.")
+    SYNC_LOCK = acquire_sync_lock(ARGS)
+    # The daemon waits for the charm to write its configuration.
+    if not ARGS.daemon:
+        for conf_file_name in [ID_CONF_FILE_NAME, CHARM_CONF_FILE_NAME]:
+            if not os.path.exists(conf_file_name):
+                log.info("{} does not exist, exiting.".format(conf_file_name))
+                sys.exit(1)
+
+
+import glanceclient
+from keystoneauth1 import identity as ks_identity
+from keystoneauth1 import session as ks_session
 from keystoneclient.v2_0 import client as keystone_client
 from keystoneclient.v3 import client as keystone_v3_client
 import keystoneclient.exceptions as keystone_exceptions
 import kombu
+import requests
+from simplestreams import contentsource
 from simplestreams.mirrors import glance, UrlMirrorReader
 from simplestreams.objectstores.swift import SwiftObjectStore
 from simplestreams.objectstores import FileStore
-from simplestreams.util import read_signed, path_from_mirror_url
-import sys
-import time
+from simplestreams.util import (read_signed, path_from_mirror_url,
+                                products_del, products_exdata,
+                                products_set)
+import swiftclient.client as swift_client
+from concurrent import futures
+import shlex
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
 import traceback
 import yaml
 import subprocess
 
 KEYRING = '/usr/share/keyrings/ubuntu-cloudimage-keyring.gpg'
-CONF_FILE_DIR = '/etc/glance-simplestreams-sync'
-PID_FILE_DIR = '/var/run'
-CHARM_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'mirrors.yaml')
-ID_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'identity.yaml')
-
-SYNC_RUNNING_FLAG_FILE_NAME = os.path.join(PID_FILE_DIR,
-                                           'glance-simplestreams-sync.pid')
 
 # juju looks in simplestreams/data/* in swift to figure out which
 # images to deploy, so this path isn't really configurable even though
@@ -92,6 +190,96 @@ PRODUCT_STREAMS_SERVICE_DESC = 'Ubuntu Product Streams'
 
 CRON_POLL_FILENAME = '/etc/cron.d/glance_simplestreams_sync_fastpoll'
 
+# Seconds between syncs for each 'frequency' when running with --daemon.
+SYNC_INTERVALS = {'hourly': 60 * 60,
+                  'daily': 24 * 60 * 60,
+                  'weekly': 7 * 24 * 60 * 60}
+
+# Bounds of the backoff between attempts while the cloud is not ready.
+READINESS_BACKOFF_MIN = 60
+READINESS_BACKOFF_MAX = 30 * 60
+
+# While waiting for the next sync, the daemon checks this often whether the
+# charm rewrote its configuration files.
+CONF_POLL_INTERVAL = 60
+
+# Persistent state kept between runs (caches, journals).
+STATE_DIR = '/var/lib/glance-simplestreams-sync'
+METADATA_CACHE_DIR = os.path.join(STATE_DIR, 'metadata-cache')
+SIGNATURE_CACHE_FILE = os.path.join(STATE_DIR, 'signature-cache.json')
+SIGNATURE_CACHE_MAX_ENTRIES = 1024
+PARTIAL_DOWNLOAD_DIR = os.path.join(STATE_DIR, 'partial')
+BLOB_CACHE_DIR = os.path.join(STATE_DIR, 'blobs')
+AUTH_STATE_FILE = os.path.join(STATE_DIR, 'auth-state.json')
+IMAGE_INDEX_FILE = os.path.join(STATE_DIR, 'images.sqlite')
+ITEM_JOURNAL_FILE = os.path.join(STATE_DIR, 'item-journal.log')
+THROUGHPUT_HISTORY_FILE = os.path.join(STATE_DIR, 'throughput.json')
+
+
+def ensure_state_dir(path=STATE_DIR):
+    """Create path, STATE_DIR or a directory of it, if it does not exist."""
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o750)
+
+
+def atomic_write(path, data, mode=0o640):
+    """Replace the file at path with data, a str or bytes.
+
+    data is written to a temporary file of the calling thread first, so
+    readers and concurrent writers only ever see a complete file.
+    """
+    ensure_state_dir(os.path.dirname(path))
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+# Weight of the last sync in the moving average of ThroughputHistory.
+THROUGHPUT_WEIGHT = 0.3
+
+# Checksums simplestreams may advertise for an item, strongest first.
+CHECKSUM_ALGORITHMS = ('sha512', 'sha256', 'md5')
+
+# A resumable download is fsync'ed and journaled every this many bytes.
+JOURNAL_INTERVAL = 64 * 1024 * 1024
+
+HTTP_TIMEOUT = 60
+
+# Segments swift accepts in a Static Large Object manifest, its default
+# max_manifest_segments.
+SWIFT_MAX_MANIFEST_SEGMENTS = 1000
+
+# Sync progress messages, other than the first and last of each image,
+# are sent at most every PROGRESS_MIN_INTERVAL seconds and once an image
+# progressed by PROGRESS_MIN_STEP of its size.
+PROGRESS_MIN_INTERVAL = 5
+PROGRESS_MIN_STEP = 0.01
+
+# Status messages waiting to be published, see StatusExchange.
+STATUS_QUEUE_SIZE = 100
+STATUS_PUBLISH_ATTEMPTS = 3
+STATUS_PUBLISH_RETRY_DELAY = 5
+STATUS_FLUSH_TIMEOUT = 60
+HTTP_POOL_SIZE = 10
+
+# How long glance may take to import an image with image_import_method.
+IMAGE_IMPORT_TIMEOUT = 2 * 60 * 60
+IMAGE_IMPORT_POLL_INTERVAL = 10
+
+# Deleting an expired glance image is retried with an exponential backoff.
+IMAGE_DELETE_ATTEMPTS = 3
+IMAGE_DELETE_RETRY_DELAY = 5
+
+# Images are converted to disk_format by this many qemu-img processes.
+IMAGE_CONVERT_WORKERS = 2
+CONVERT_READ_SIZE = 1024 * 1024
+# Checksums published for a converted image.
+CONVERTED_CHECKSUMS = ('md5', 'sha256')
+
 CACERT_FILE = os.path.join(CONF_FILE_DIR, 'cacert.pem')
 SYSTEM_CACERT_FILE = '/etc/ssl/certs/ca-certificates.crt'
 
@@ -112,11 +300,2265 @@ except ImportError:
     SIMPLESTREAMS_HAS_PROGRESS = False
 
 
+class MirrorSyncError(Exception):
+    """Raised when one or more mirrors in mirror_list failed to sync."""
+
+
+class SyncDeferred(MirrorSyncError):
+    """Raised when the pre-flight checks find a sync cannot complete."""
+
+
+class CachingMirrorReader(object):
+    """Mirror reader that fetches and verifies each metadata file once.
+
+    The planning pass and the sync pass walk the same index and products
+    files, the second walk is served from memory.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def read_json(self, path):
+        with self._lock:
+            if path not in self._cache:
+                self._cache[path] = self.reader.read_json(path)
+            return self._cache[path]
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+
+_http_session = None
+
+
+def setup_http_session(pool_size=HTTP_POOL_SIZE, user_agent=None):
+    """Replace the session returned by http_session().
+
+    Connections are kept alive and shared by all mirrors of a run, up to
+    pool_size per host.
+    """
+    global _http_session
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if user_agent:
+        session.headers['User-Agent'] = user_agent
+    _http_session = session
+    return session
+
+
+def http_session():
+    """Return the requests session used for direct HTTP requests."""
+    if _http_session is None:
+        setup_http_session()
+    return _http_session
+
+
+class PooledUrlReader(contentsource.UrlReader):
+    """simplestreams url reader fetching through http_session()."""
+
+    def __init__(self, url, buflen=None, user_agent=None):
+        self.url = url
+        headers = {'User-Agent': user_agent} if user_agent else None
+        self.response = http_session().get(url, headers=headers, stream=True,
+                                           timeout=HTTP_TIMEOUT)
+        if self.response.status_code == 404:
+            self.response.close()
+            raise IOError(errno.ENOENT, "Unable to open {}".format(url))
+        self.response.raise_for_status()
+        self._chunks = self.response.iter_content(
+            chunk_size=buflen or 1024 * 1024)
+        self._leftover = bytearray()
+        self._consumed = False
+
+    def read(self, size=-1):
+        while not self._consumed and (size is None or size < 0 or
+                                      len(self._leftover) < size):
+            try:
+                self._leftover += next(self._chunks)
+            except StopIteration:
+                self._consumed = True
+        if size is None or size < 0:
+            size = len(self._leftover)
+        data = bytes(self._leftover[:size])
+        del self._leftover[:size]
+        return data
+
+    def close(self):
+        self.response.close()
+
+
+class PooledUrlMirrorReader(UrlMirrorReader):
+    """UrlMirrorReader whose http(s) sources use PooledUrlReader."""
+
+    def source(self, path):
+        src = super(PooledUrlMirrorReader, self).source(path)
+        if self.prefix.startswith(('http://', 'https://')):
+            src.url_reader = functools.partial(PooledUrlReader,
+                                               user_agent=self.user_agent)
+        return src
+
+
+class MetadataCache(object):
+    """On-disk cache of index and products files.
+
+    The ETag and Last-Modified headers of each cached URL are kept next to
+    its content and sent back as a conditional request, so unchanged files
+    are answered with a 304 and read from disk.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        ensure_state_dir(cache_dir)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.meta', base + '.data'
+
+    def fetch(self, url):
+        """Return the content of url, from disk if it did not change."""
+        meta_path, data_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = {}
+
+        headers = {}
+        if meta and os.path.exists(data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = http_session().get(url, headers=headers,
+                                      timeout=HTTP_TIMEOUT)
+        if response.status_code == 304 and headers:
+            with open(data_path, 'rb') as f:
+                content = f.read()
+            self._count(hit=True)
+            log.debug("metadata cache hit for {}".format(url))
+            return content
+
+        response.raise_for_status()
+        content = response.content
+        meta = {'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+        if meta['etag'] or meta['last_modified']:
+            atomic_write(meta_path, json.dumps(meta))
+            atomic_write(data_path, content)
+        self._count(hit=False)
+        return content
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total:
+            log.info("metadata cache: {} of {} requests not modified "
+                     "({:.0%} hit ratio)".format(self.hits, total,
+                                                 float(self.hits) / total))
+
+
+class ConditionalUrlMirrorReader(PooledUrlMirrorReader):
+    """UrlMirrorReader reading index and products files via MetadataCache."""
+
+    def __init__(self, prefix, metadata_cache, **kwargs):
+        super(ConditionalUrlMirrorReader, self).__init__(prefix, **kwargs)
+        self.metadata_cache = metadata_cache
+
+    def read_json(self, path):
+        url = self.prefix + path
+        if not url.startswith(('http://', 'https://')):
+            return super(ConditionalUrlMirrorReader, self).read_json(path)
+
+        try:
+            raw = self.metadata_cache.fetch(url).decode('utf-8')
+        except Exception as e:
+            log.warning("conditional fetch of {} failed, retrying without "
+                        "cache: {}".format(url, e))
+            return super(ConditionalUrlMirrorReader, self).read_json(path)
+        return raw, self.policy(content=raw, path=path)
+
+
+def item_checksums(item):
+    """Return {algorithm: hexdigest} for the checksums an item advertises."""
+    return dict((algo, item[algo]) for algo in CHECKSUM_ALGORITHMS
+                if item.get(algo))
+
+
+class ChecksumMismatchError(IOError):
+    """Raised when downloaded content does not match its stream checksum."""
+
+
+# Only one sync process runs at a time (see SYNC_RUNNING_FLAG_FILE_NAME),
+# but the same URL may be requested by two mirrors of the same run.
+_partial_locks = {}
+
+
+class ResumableContentSource(contentsource.ContentSource):
+    """Content source staging a download to a partial file.
+
+    Progress is recorded in a journal next to the partial file (verified
+    offset, sha256 of the bytes up to it and the upstream validators), so
+    an interrupted download continues with a Range request on the next
+    attempt. Bytes already on disk are replayed to the reader first, the
+    caller sees the same stream as with a plain download.
+    """
+
+    def __init__(self, url, partial_dir, size=None, checksums=None):
+        self.url = url
+        self.size = int(size) if size is not None else None
+        self.checksums = checksums or {}
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        self.partial_path = os.path.join(partial_dir, key + '.partial')
+        self.journal_path = self.partial_path + '.journal'
+        self.response = None
+        self.replay = None
+        self.out = None
+        self.complete = False
+        self.replayed = 0
+        self.lock = _partial_locks.setdefault(self.partial_path,
+                                              threading.Lock())
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_path) as f:
+                journal = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (journal.get('url') != self.url or
+                not os.path.exists(self.partial_path) or
+                os.path.getsize(self.partial_path) < journal['offset']):
+            return None
+        return journal
+
+    def _new_hashers(self):
+        algorithms = set(self.checksums) | set(['sha256'])
+        return dict((algo, hashlib.new(algo)) for algo in algorithms)
+
+    def _verify_prefix(self, journal):
+        """Hash the journaled part of the partial file."""
+        hashers = self._new_hashers()
+        remaining = journal['offset']
+        with open(self.partial_path, 'rb') as f:
+            while remaining:
+                buf = f.read(min(remaining, 1024 * 1024))
+                if not buf:
+                    return None
+                for h in hashers.values():
+                    h.update(buf)
+                remaining -= len(buf)
+        if hashers['sha256'].hexdigest() != journal['sha256']:
+            log.warning("{} does not match its journal, restarting "
+                        "download".format(self.partial_path))
+            return None
+        return hashers
+
+    def _request(self, offset, journal):
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            validator = journal.get('etag') or journal.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+        response = http_session().get(self.url, headers=headers, stream=True,
+                                      timeout=HTTP_TIMEOUT)
+        if response.status_code == 404:
+            response.close()
+            raise IOError(errno.ENOENT, "{} not found".format(self.url))
+        response.raise_for_status()
+        return response
+
+    def open(self):
+        if self.response is not None:
+            return
+
+        self.lock.acquire()
+        try:
+            self._open()
+        except Exception:
+            self.lock.release()
+            raise
+
+    def _open(self):
+        journal = self._load_journal()
+        hashers = self._verify_prefix(journal) if journal else None
+        offset = journal['offset'] if hashers else 0
+
+        response = self._request(offset, journal)
+        etag = response.headers.get('ETag')
+        if offset and (response.status_code != 206 or
+                       (journal.get('etag') and etag != journal['etag'])):
+            # Ranges not honoured or the upstream file changed.
+            log.info("cannot resume {}, fetching it again".format(self.url))
+            response.close()
+            offset = 0
+            response = self._request(0, None)
+            etag = response.headers.get('ETag')
+
+        if offset:
+            log.info("resuming {} at byte {}".format(self.url, offset))
+            self.replay = open(self.partial_path, 'rb')
+            self.out = open(self.partial_path, 'r+b')
+            self.out.seek(offset)
+            self.out.truncate()
+        else:
+            hashers = self._new_hashers()
+            self.out = open(self.partial_path, 'wb')
+
+        self.hashers = hashers
+        self.offset = offset
+        self.journaled = offset
+        self.replay_remaining = offset
+        self.etag = etag
+        self.last_modified = response.headers.get('Last-Modified')
+        self.response = response
+
+    def _write_journal(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        journal = {'url': self.url,
+                   'etag': self.etag,
+                   'last_modified': self.last_modified,
+                   'offset': self.offset,
+                   'sha256': self.hashers['sha256'].copy().hexdigest()}
+        atomic_write(self.journal_path, json.dumps(journal))
+        self.journaled = self.offset
+
+    def _verify(self):
+        if self.size is not None and self.offset != self.size:
+            raise ChecksumMismatchError(
+                "{}: expected {} bytes, got {}".format(self.url, self.size,
+                                                       self.offset))
+        for algo, expected in self.checksums.items():
+            found = self.hashers[algo].hexdigest()
+            if found != expected:
+                raise ChecksumMismatchError(
+                    "{}: {} mismatch, expected {} got {}".format(
+                        self.url, algo, expected, found))
+
+    def read(self, size=-1):
+        self.open()
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                buf = self.read(1024 * 1024)
+                if not buf:
+                    return b''.join(chunks)
+                chunks.append(buf)
+
+        # Readers like simplestreams' get_local_copy() take a short read
+        # for the end of the content, so a request is only answered short
+        # at the end of the download: what the replay leaves of it is read
+        # from the network.
+        replayed = b''
+        if self.replay_remaining:
+            replayed = self.replay.read(min(size, self.replay_remaining))
+            if not replayed:
+                raise IOError("{} is shorter than its journal".format(
+                    self.partial_path))
+            self.replay_remaining -= len(replayed)
+            self.replayed += len(replayed)
+            if len(replayed) == size:
+                return replayed
+
+        wanted = size - len(replayed)
+        buf = self._read_response(wanted)
+        if buf:
+            self.out.write(buf)
+            for h in self.hashers.values():
+                h.update(buf)
+            self.offset += len(buf)
+            if self.offset - self.journaled >= JOURNAL_INTERVAL:
+                self._write_journal()
+
+        # A short read is the end of the download, the reader may not ask
+        # for more.
+        if len(buf) < wanted and not self.complete:
+            try:
+                self._verify()
+            except ChecksumMismatchError:
+                # Not journaled again by close().
+                self.out.close()
+                self.out = None
+                self._discard()
+                raise
+            self.complete = True
+        return replayed + buf
+
+    def _read_response(self, size):
+        """Read size bytes from the network, fewer only at its end."""
+        chunks = []
+        while size > 0:
+            buf = self.response.raw.read(size, decode_content=True)
+            if not buf:
+                break
+            chunks.append(buf)
+            size -= len(buf)
+        return b''.join(chunks)
+
+    def _discard(self):
+        for path in (self.partial_path, self.journal_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        if self.replay is not None:
+            self.replay.close()
+            self.replay = None
+        if self.out is not None:
+            if not self.complete and self.offset > self.journaled:
+                self._write_journal()
+            self.out.close()
+            self.out = None
+        if self.complete:
+            self._discard()
+        if self.response is not None:
+            self.response = None
+            self.lock.release()
+
+
+class BlobCache(object):
+    """Local content-addressed store of image files, keyed by sha256.
+
+    Shared by all mirrors of a run. The least recently used files are
+    evicted once the total size goes over max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        ensure_state_dir(cache_dir)
+
+    def lookup(self, sha256):
+        """Return the path of the blob for sha256, or None."""
+        path = os.path.join(self.cache_dir, sha256)
+        with self._lock:
+            try:
+                os.utime(path, None)
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return path
+
+    def create_temp(self, sha256):
+        tmp_path = os.path.join(self.cache_dir, '.{}.{}.tmp'.format(
+            sha256, threading.current_thread().ident))
+        return tmp_path, open(tmp_path, 'wb')
+
+    def commit(self, tmp_path, sha256):
+        with self._lock:
+            os.rename(tmp_path, os.path.join(self.cache_dir, sha256))
+            self._evict()
+
+    def discard(self, sha256):
+        try:
+            os.unlink(os.path.join(self.cache_dir, sha256))
+        except OSError:
+            pass
+
+    def _evict(self):
+        blobs = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            st = os.stat(os.path.join(self.cache_dir, name))
+            blobs.append((st.st_mtime, st.st_size, name))
+        total = sum(b[1] for b in blobs)
+        for _, size, name in sorted(blobs):
+            if total <= self.max_size:
+                break
+            log.info("evicting {} from blob cache".format(name))
+            os.unlink(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total:
+            log.info("blob cache: {} of {} images served locally".format(
+                self.hits, total))
+
+
+class CachedBlobContentSource(contentsource.ContentSource):
+    """Content source reading an item from the blob cache."""
+
+    def __init__(self, blob_cache, path, sha256):
+        self.url = 'file://' + path
+        self.blob_cache = blob_cache
+        self.sha256 = sha256
+        self.fd = open(path, 'rb')
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        buf = self.fd.read(size)
+        if self.hasher is None:
+            return buf
+        self.hasher.update(buf)
+        if size is None or size < 0 or len(buf) < size:
+            # The end of the blob, readers may not ask for more.
+            found, self.hasher = self.hasher.hexdigest(), None
+            if found != self.sha256:
+                self.blob_cache.discard(self.sha256)
+                raise ChecksumMismatchError(
+                    "cached blob {} is corrupt, removed it".format(
+                        self.sha256))
+        return buf
+
+    def close(self):
+        self.fd.close()
+
+
+class BlobCacheFillingContentSource(contentsource.ContentSource):
+    """Content source copying what is read from source into the cache."""
+
+    def __init__(self, source, blob_cache, sha256):
+        self.source = source
+        self.url = getattr(source, 'url', None)
+        self.blob_cache = blob_cache
+        self.sha256 = sha256
+        self.hasher = hashlib.sha256()
+        self.tmp_path = None
+        self.tmp = None
+
+    def read(self, size=-1):
+        if self.tmp is None and self.hasher is not None:
+            self.tmp_path, self.tmp = self.blob_cache.create_temp(self.sha256)
+
+        buf = self.source.read(size)
+        if self.hasher is None:
+            return buf
+        self.tmp.write(buf)
+        self.hasher.update(buf)
+        if size is None or size < 0 or len(buf) < size:
+            # A short read is the end of the item, see CachedBlobContentSource.
+            found, self.hasher = self.hasher.hexdigest(), None
+            self.tmp.close()
+            self.tmp = None
+            if found == self.sha256:
+                self.blob_cache.commit(self.tmp_path, self.sha256)
+            else:
+                os.unlink(self.tmp_path)
+        return buf
+
+    def close(self):
+        self.source.close()
+        if self.tmp is not None:
+            # Not read to the end, do not keep a truncated blob.
+            self.tmp.close()
+            self.tmp = None
+            os.unlink(self.tmp_path)
+
+
+class TokenBucket(object):
+    """Token bucket limiting the rate of transfers sharing it.
+
+    rate is a callable returning the allowed bytes per second, or None for
+    no limit. It is called for every read, so a change of bandwidth window
+    applies to transfers in progress. Readers take their tokens upfront
+    and sleep off any deficit, which keeps the average rate right when
+    several threads share the bucket.
+    """
+
+    def __init__(self, rate, burst_seconds=1):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.time()
+
+    def consume(self, amount):
+        with self._lock:
+            rate = self.rate()
+            now = time.time()
+            elapsed, self._last = now - self._last, now
+            if not rate:
+                self._tokens = 0.0
+                return
+            self._tokens = min(self._tokens + elapsed * rate,
+                               rate * self.burst_seconds)
+            self._tokens -= amount
+            wait = -self._tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_bandwidth_schedule(schedule):
+    """Parse 'HH:MM-HH:MM=MBIT ...' into (start, end, mbit) tuples.
+
+    start and end are minutes since midnight, a window may wrap around
+    midnight.
+    """
+    windows = []
+    for entry in (schedule or '').replace(',', ' ').split():
+        try:
+            span, mbit = entry.split('=')
+            start, end = [int(h) * 60 + int(m) for h, m in
+                          (t.split(':') for t in span.split('-'))]
+            windows.append((start, end, float(mbit)))
+        except ValueError:
+            raise ValueError("invalid bandwidth_schedule window {!r}, "
+                             "expected HH:MM-HH:MM=MBIT".format(entry))
+    return windows
+
+
+def bandwidth_rate(limit, windows=()):
+    """Return a TokenBucket rate callable for limit Mbit/s, or the limit of
+    the window of windows the local time is in. 0 means no limit."""
+    def rate():
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        mbit = limit
+        for start, end, window_mbit in windows:
+            if (start <= minute < end if start <= end else
+                    minute >= start or minute < end):
+                mbit = window_mbit
+                break
+        return mbit * 1000 * 1000 / 8 if mbit else None
+    return rate
+
+
+class RateLimitedContentSource(contentsource.ContentSource):
+    """Content source throttled by one or more TokenBuckets."""
+
+    def __init__(self, source, buckets):
+        self.source = source
+        self.url = getattr(source, 'url', None)
+        self.buckets = buckets
+
+    def read(self, size=-1):
+        buf = self.source.read(size)
+        for bucket in self.buckets:
+            bucket.consume(len(buf))
+        return buf
+
+    def close(self):
+        self.source.close()
+
+
+class TeeTransfer(object):
+    """One upstream read of an item shared by several consumers.
+
+    A pump thread spools the upstream content to a temporary file, each
+    consumer reads it from there at its own pace through a TeeBranch, so
+    a slow glance upload never stalls the others. The spool file is
+    removed once every expected consumer closed its branch.
+    """
+
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, source, consumers):
+        self.source = source
+        self.remaining = consumers
+        fd, self.spool_path = tempfile.mkstemp(prefix='gss-tee-')
+        self.spool = os.fdopen(fd, 'wb')
+        self.written = 0
+        self.eof = False
+        self.error = None
+        self.cancelled = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._pump)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _pump(self):
+        try:
+            while not self.cancelled:
+                buf = self.source.read(self.READ_SIZE)
+                if buf:
+                    self.spool.write(buf)
+                    self.spool.flush()
+                with self.cond:
+                    self.written += len(buf)
+                    self.eof = not buf
+                    self.cond.notify_all()
+                if not buf:
+                    break
+        except Exception as e:
+            log.exception("Exception reading {}:".format(
+                getattr(self.source, 'url', 'upstream')))
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+        finally:
+            self.source.close()
+            self.spool.close()
+
+    def branch(self):
+        return TeeBranch(self)
+
+    def release(self):
+        with self.cond:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        self.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            os.unlink(self.spool_path)
+        except OSError:
+            pass
+
+
+class TeeBranch(contentsource.ContentSource):
+    """A consumer's view of a TeeTransfer."""
+
+    def __init__(self, transfer):
+        self.transfer = transfer
+        self.url = getattr(transfer.source, 'url', None)
+        self.fd = open(transfer.spool_path, 'rb')
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                buf = self.read(TeeTransfer.READ_SIZE)
+                if not buf:
+                    return b''.join(chunks)
+                chunks.append(buf)
+
+        # Consumers like simplestreams' get_local_copy() take a short read
+        # for the end of the item, so a branch catching up with the pump
+        # waits for the whole request.
+        t = self.transfer
+        with t.cond:
+            while (t.written - self.offset < size and not t.eof and
+                   t.error is None):
+                t.cond.wait()
+            available = t.written - self.offset
+            if available < size and t.error is not None:
+                raise t.error
+        if not available:
+            return b''
+        buf = self.fd.read(min(size, available))
+        self.offset += len(buf)
+        return buf
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+            self.transfer.release()
+
+
+class TransferHub(object):
+    """Shares upstream item downloads between the regions of a mirror.
+
+    expected maps (content_id, pedigree) to the number of regions that
+    are going to insert that item, as computed by their sync plans.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self._transfers = {}
+        self._lock = threading.Lock()
+
+    def source(self, key, open_upstream):
+        with self._lock:
+            consumers = self.expected.get(key, 1)
+            if consumers <= 1:
+                return open_upstream()
+
+            transfer, joined = self._transfers.get(key, (None, 0))
+            if transfer is None:
+                log.info("sharing download of {} between {} regions".format(
+                    '/'.join(key[1]), consumers))
+                transfer = TeeTransfer(open_upstream(), consumers)
+            joined += 1
+            if joined < consumers:
+                self._transfers[key] = (transfer, joined)
+            else:
+                self._transfers.pop(key, None)
+            return transfer.branch()
+
+    def close(self):
+        """Drop transfers that some region never picked up."""
+        with self._lock:
+            for transfer, _ in self._transfers.values():
+                transfer.cancel()
+            self._transfers = {}
+
+
+class StreamingVerifier(object):
+    """File-like reader hashing an item as it flows through it.
+
+    Computes every checksum the stream advertises for the item (plus md5,
+    which glance reports back) in a single pass; verify() is called once
+    the source is exhausted.
+    """
+
+    def __init__(self, source, size=None, checksums=None, progress=None):
+        self.source = source
+        self.size = int(size) if size is not None else None
+        self.checksums = checksums or {}
+        self.hashers = dict((algo, hashlib.new(algo)) for algo in
+                            set(self.checksums) | set(['md5']))
+        self.bytes_read = 0
+        self.progress = progress
+
+    def read(self, size=-1):
+        buf = self.source.read(size)
+        if buf:
+            for h in self.hashers.values():
+                h.update(buf)
+            self.bytes_read += len(buf)
+            if self.progress is not None:
+                self.progress(len(buf))
+        return buf
+
+    def verify(self):
+        if self.size is not None and self.bytes_read != self.size:
+            raise ChecksumMismatchError(
+                "{}: expected {} bytes, got {}".format(
+                    getattr(self.source, 'url', 'item'), self.size,
+                    self.bytes_read))
+        for algo, expected in self.checksums.items():
+            found = self.hashers[algo].hexdigest()
+            if found != expected:
+                raise ChecksumMismatchError(
+                    "{}: {} mismatch, expected {} got {}".format(
+                        getattr(self.source, 'url', 'item'), algo, expected,
+                        found))
+
+
+class ImageStream(object):
+    """Feeds an item to glance through a named pipe, without a temp file.
+
+    GlanceMirror uploads what download_image() returns as a local path. A
+    writer thread pushes the verified stream into a FIFO at that path,
+    holding back the last chunk until all checksums matched, so glance
+    never receives a complete image that failed verification.
+    """
+
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, verifier):
+        self.verifier = verifier
+        self.tmp_dir = tempfile.mkdtemp(prefix='gss-stream-')
+        self.path = os.path.join(self.tmp_dir, 'image')
+        os.mkfifo(self.path, 0o600)
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self._feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self):
+        try:
+            with open(self.path, 'wb') as fifo:
+                pending = b''
+                while not self.aborted:
+                    buf = self.verifier.read(self.READ_SIZE)
+                    if not buf:
+                        break
+                    if pending:
+                        fifo.write(pending)
+                    pending = buf
+                if not self.aborted:
+                    self.verifier.verify()
+                    fifo.write(pending)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.verifier.source.close()
+
+    def finish(self):
+        """Wait for the writer and return the error it hit, if any."""
+        if self.thread.is_alive():
+            # The upload never opened the pipe (or stopped reading it).
+            # Keep it open for reading, so the writer can open it however
+            # far it got, and drain it until the writer notices the abort.
+            self.aborted = True
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError:
+                fd = None
+            deadline = time.time() + HTTP_TIMEOUT
+            try:
+                while self.thread.is_alive() and time.time() < deadline:
+                    if fd is not None:
+                        try:
+                            while os.read(fd, self.READ_SIZE):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    self.thread.join(0.1)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        self.thread.join(HTTP_TIMEOUT)
+        if self.thread.is_alive():
+            log.warning("writer of {} did not stop".format(self.path))
+        # GlanceMirror already unlinked the pipe, when it opened it.
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        return self.error
+
+
+class GlanceImagesProxy(object):
+    """Proxy of a glanceclient images manager.
+
+    The id of the last image created by each thread is kept in local, so
+    a failed insert can delete the half-created image it left behind, and
+    passed to on_create. When local.import_uri is set, upload() hands over
+    to importer instead of sending the (empty) local file.
+    """
+
+    def __init__(self, images, local, importer=None, on_create=None):
+        self._images = images
+        self._local = local
+        self._importer = importer
+        self._on_create = on_create
+
+    def create(self, **kwargs):
+        image = self._images.create(**kwargs)
+        self._local.created_image_id = image.id
+        if self._on_create is not None:
+            self._on_create(image.id)
+        return image
+
+    def upload(self, image_id, *args, **kwargs):
+        uri = getattr(self._local, 'import_uri', None)
+        if uri and self._importer is not None:
+            return self._importer(image_id, uri)
+        return self._images.upload(image_id, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._images, name)
+
+
+class SegmentedSwiftObjectStore(SwiftObjectStore):
+    """SwiftObjectStore uploading large payloads as Static Large Objects.
+
+    GlanceMirror only writes the product streams metadata (the
+    streams/v1/*.json files) to its store, images go to glance. So this
+    only applies to products files over segment_size bytes, with a small
+    swift_segment_size or a very large mirror.
+
+    Such payloads are cut into segments that are spooled to local
+    temporary files and uploaded by up to segment_workers threads into the
+    '<container>_segments' container, then tied together by a manifest.
+    Smaller payloads are still written with a single PUT. The segments of
+    the object being replaced are deleted once it is. A segment_size of 0
+    keeps single-object PUTs.
+
+    With a keystone_session, swift connections authenticate with it
+    instead of with their own password authentication.
+    """
+
+    def __init__(self, prefix, segment_size=0, segment_workers=1,
+                 keystone_session=None, **kwargs):
+        self.keystone_session = keystone_session
+        if keystone_session is None:
+            super(SegmentedSwiftObjectStore, self).__init__(prefix, **kwargs)
+        else:
+            # What SwiftObjectStore.__init__() does, with a connection
+            # from the shared session.
+            self.prefix = prefix
+            path = prefix[8:] if prefix.startswith("swift://") else prefix
+            (self.container, self.path_prefix) = path.split("/", 1)
+            self.swiftclient = self._session_connection(
+                kwargs.get('region'))
+            # http://docs.openstack.org/developer/swift/misc.html#acls
+            self.swiftclient.put_container(
+                self.container, headers={'X-Container-Read':
+                                         '.r:*,.rlistings'})
+        self.region = kwargs.get('region')
+        self.segment_size = segment_size
+        self.segment_workers = max(int(segment_workers or 1), 1)
+        self.segment_container = self.container + '_segments'
+        self._local = threading.local()
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        if not self.segment_size:
+            return (super(SegmentedSwiftObjectStore, self)
+                    .insert(path, reader, checksums=checksums,
+                            mutable=mutable, size=size))
+        if size is not None and int(size) <= self.segment_size:
+            old_segments = self._manifest_segments(self.path_prefix + path)
+            (super(SegmentedSwiftObjectStore, self)
+             .insert(path, reader, checksums=checksums, mutable=mutable,
+                     size=size))
+            self._delete_segments(old_segments)
+            return
+        self._insert_segmented(path, reader, checksums or {}, mutable, size)
+
+    def _connection(self):
+        """Return this thread's swift connection, swiftclient's are not
+        thread safe."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None and self.keystone_session is not None:
+            conn = self._local.conn = self._session_connection(self.region)
+        elif conn is None:
+            conn = self._local.conn = swift_client.Connection(
+                preauthurl=self.swiftclient.url,
+                preauthtoken=self.swiftclient.token,
+                insecure=getattr(self.swiftclient, 'insecure', False),
+                cacert=getattr(self.swiftclient, 'cacert', None))
+        return conn
+
+    def _session_connection(self, region):
+        ks = self.keystone_session
+        return swift_client.Connection(
+            session=ks.session, cacert=ks.cacert,
+            os_options={'region_name': region or
+                        os.environ.get('OS_REGION_NAME'),
+                        'endpoint_type': ks.interface})
+
+    def _manifest_segments(self, objname):
+        """Return the segments of objname if it is a Static Large Object."""
+        try:
+            headers = self.swiftclient.head_object(self.container, objname)
+            if (headers.get('x-static-large-object', '').lower() !=
+                    'true'):
+                return []
+            _, body = self.swiftclient.get_object(
+                self.container, objname,
+                query_string='multipart-manifest=get')
+            return [segment['name'] for segment in json.loads(body)]
+        except swift_client.ClientException as e:
+            if e.http_status != 404:
+                log.warning("could not read manifest of {}: {}".format(
+                    objname, e))
+            return []
+        except ValueError as e:
+            log.warning("could not read manifest of {}: {}".format(
+                objname, e))
+            return []
+
+    def _delete_segments(self, segments):
+        """Delete segments, given as '/<container>/<name>' paths."""
+        for segment in segments:
+            container, name = segment.lstrip('/').split('/', 1)
+            try:
+                self._connection().delete_object(container, name)
+            except swift_client.ClientException as e:
+                if e.http_status != 404:
+                    log.warning("could not delete segment {}: {}".format(
+                        segment, e))
+
+    def _put_segment(self, name, spool, size, etag):
+        try:
+            self._connection().put_object(self.segment_container, name,
+                                          contents=spool,
+                                          content_length=size, etag=etag)
+        finally:
+            spool.close()
+
+    def _spool_segment(self, reader, hashers, segment_size):
+        spool = tempfile.TemporaryFile()
+        md5 = hashlib.md5()
+        copied = 0
+        while copied < segment_size:
+            buf = reader.read(min(1024 * 1024, segment_size - copied))
+            if not buf:
+                break
+            spool.write(buf)
+            md5.update(buf)
+            for h in hashers.values():
+                h.update(buf)
+            copied += len(buf)
+        spool.seek(0)
+        return spool, copied, md5.hexdigest()
+
+    def _check_checksums(self, objname, hashers, checksums):
+        for algo, expected in checksums.items():
+            if hashers[algo].hexdigest() != expected:
+                raise ChecksumMismatchError(
+                    "{}: {} mismatch, not writing it".format(objname, algo))
+
+    def _insert_segmented(self, path, reader, checksums, mutable=True,
+                          total_size=None):
+        objname = self.path_prefix + path
+        hashers = dict((algo, hashlib.new(algo)) for algo in checksums)
+        old_segments = self._manifest_segments(objname)
+
+        segment_size = self.segment_size
+        if total_size is not None:
+            # Larger segments when the manifest would exceed swift's limit.
+            segment_size = max(segment_size, -(-int(total_size) //
+                                               SWIFT_MAX_MANIFEST_SEGMENTS))
+
+        spool, size, etag = self._spool_segment(reader, hashers,
+                                                segment_size)
+        if size < segment_size:
+            # Fits in a single object after all.
+            try:
+                self._check_checksums(objname, hashers, checksums)
+                (super(SegmentedSwiftObjectStore, self)
+                 .insert(path, spool, mutable=mutable, size=size))
+            finally:
+                spool.close()
+            self._delete_segments(old_segments)
+            return
+
+        prefix = '{}/slo/{:.6f}/{}'.format(objname, time.time(),
+                                           segment_size)
+        self.swiftclient.put_container(self.segment_container)
+        manifest = []
+        jobs = []
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=self.segment_workers) as pool:
+                while size:
+                    if len(manifest) == SWIFT_MAX_MANIFEST_SEGMENTS:
+                        spool.close()
+                        raise IOError(
+                            "{} needs more than {} segments of {} bytes, "
+                            "raise swift_segment_size".format(
+                                objname, SWIFT_MAX_MANIFEST_SEGMENTS,
+                                segment_size))
+                    name = '{}/{:08d}'.format(prefix, len(manifest))
+                    manifest.append({
+                        'path': '/{}/{}'.format(self.segment_container,
+                                                name),
+                        'etag': etag,
+                        'size_bytes': size})
+                    jobs.append(pool.submit(self._put_segment, name, spool,
+                                            size, etag))
+                    if size < segment_size:
+                        break
+                    # Bound the number of segments spooled on local disk.
+                    while (sum(not j.done() for j in jobs) >=
+                           self.segment_workers):
+                        futures.wait(jobs,
+                                     return_when=futures.FIRST_COMPLETED)
+                    spool, size, etag = self._spool_segment(
+                        reader, hashers, segment_size)
+                if not size:
+                    spool.close()
+                for job in jobs:
+                    job.result()
+
+            self._check_checksums(objname, hashers, checksums)
+            log.info("writing manifest for {} ({} segments)".format(
+                objname, len(manifest)))
+            self.swiftclient.put_object(
+                self.container, objname, contents=json.dumps(manifest),
+                query_string='multipart-manifest=put')
+        except Exception:
+            self._delete_segments(segment['path'] for segment in manifest)
+            raise
+        self._delete_segments(old_segments)
+
+
+class SyncedImageIndex(object):
+    """SQLite index of the images synced into glance.
+
+    Rows mirror the items of the glance target tree GlanceMirror builds by
+    listing every image, keyed by content_id, region and pedigree. Once a
+    tree was loaded from glance (reconciled) the index is kept up to date
+    by the inserts and removals of the sync, and the tree is read back
+    from it until it is older than max_age seconds.
+    """
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        ensure_state_dir(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " content_id TEXT, region TEXT, product TEXT, version TEXT,"
+                " item TEXT, image_id TEXT, checksum TEXT, size INTEGER,"
+                " synced_at REAL, data TEXT,"
+                " PRIMARY KEY (content_id, region, product, version, item))")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reconciled ("
+                " content_id TEXT, region TEXT, reconciled_at REAL,"
+                " PRIMARY KEY (content_id, region))")
+
+    def load(self, content_id, region):
+        """Return the indexed target tree, or None when it needs to be
+        reconciled with glance."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT reconciled_at FROM reconciled"
+                " WHERE content_id = ? AND region = ?",
+                (content_id, region)).fetchone()
+            if row is None or time.time() - row[0] > self.max_age:
+                return None
+            rows = self._conn.execute(
+                "SELECT product, version, item, data FROM items"
+                " WHERE content_id = ? AND region = ?",
+                (content_id, region)).fetchall()
+        tree = glance.empty_iid_products(content_id)
+        for product, version, item, data in rows:
+            products_set(tree, json.loads(data), (product, version, item))
+        return tree
+
+    def reconcile(self, content_id, region, tree):
+        """Replace the indexed items with those of tree, loaded from
+        glance."""
+        rows = []
+        for product, pdata in tree.get('products', {}).items():
+            for version, vdata in pdata.get('versions', {}).items():
+                for item, idata in vdata.get('items', {}).items():
+                    rows.append(self._row(content_id, region,
+                                          (product, version, item), idata))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM items WHERE content_id = ? AND region = ?",
+                (content_id, region))
+            self._conn.executemany(
+                "INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reconciled VALUES (?, ?, ?)",
+                (content_id, region, time.time()))
+        log.info("reconciled image index of {} in {}: {} images".format(
+            content_id, region, len(rows)))
+
+    def invalidate(self, content_id, region):
+        """Have the next load() of content_id in region list glance."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM reconciled WHERE content_id = ? AND region = ?",
+                (content_id, region))
+
+    def add(self, content_id, region, pedigree, item):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._row(content_id, region, pedigree, item))
+
+    def remove(self, content_id, region, pedigree):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM items WHERE content_id = ? AND region = ?"
+                " AND product = ? AND version = ? AND item = ?",
+                (content_id, region) + tuple(pedigree))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _row(content_id, region, pedigree, item):
+        return ((content_id, region) + tuple(pedigree) +
+                (item.get('id'), item.get('md5'), item.get('size'),
+                 time.time(), json.dumps(item)))
+
+
+def indexed_load_products(mirror, image_index, load):
+    """Return the glance target tree of mirror.
+
+    It is read from image_index when possible, otherwise load() lists
+    glance and the index is reconciled with its result.
+    """
+    content_id = mirror.config['content_id']
+    tree = image_index.load(content_id, mirror.region)
+    if tree is not None:
+        log.info("loaded {} products of {} in {} from the image "
+                 "index".format(len(tree['products']), content_id,
+                                mirror.region))
+        for product in tree['products'].values():
+            product['region'] = mirror.region
+            product['endpoint'] = mirror.auth_url
+        return tree
+    tree = load()
+    image_index.reconcile(content_id, mirror.region, tree)
+    return tree
+
+
+class ItemJournal(object):
+    """Write-ahead journal of the state of the items being inserted.
+
+    Every state change of an item (planned, downloading, uploading once its
+    glance image exists, then active or failed) is appended and fsync'ed
+    before the sync moves on, so the next run knows which items a killed
+    run left unfinished, see recover_interrupted_items().
+    """
+
+    FINAL_STATES = ('active', 'failed')
+
+    def __init__(self, path):
+        self.path = path
+        ensure_state_dir(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, region, content_id, pedigree, state, **kwargs):
+        entry = dict(kwargs, region=region, content_id=content_id,
+                     pedigree=list(pedigree), state=state, time=time.time())
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def unfinished(self):
+        """Return the last entry of the items not in a final state."""
+        last = collections.OrderedDict()
+        with self._lock, open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write of the killed run.
+                    continue
+                key = (entry['region'], entry['content_id'],
+                       tuple(entry['pedigree']))
+                last[key] = entry
+        return [entry for entry in last.values()
+                if entry['state'] not in self.FINAL_STATES]
+
+    def reset(self):
+        with self._lock:
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def recover_interrupted_items(item_journal, keystone_session,
+                              image_index=None):
+    """Settle the items a previous, interrupted run left unfinished.
+
+    Glance images created for them are kept when they are active with the
+    checksum and size the stream advertises, so the sync finds them in
+    glance and skips them. The image_index never saw these images, so it
+    is reconciled with glance again. Others (queued, saving or incomplete)
+    are deleted. Items interrupted before their image was created have
+    nothing to clean up and are simply synced again.
+    """
+    clients = {}
+    for entry in item_journal.unfinished():
+        item = '/'.join(entry['pedigree'])
+        image_id = entry.get('image_id')
+        if not image_id:
+            log.info("{} was interrupted in state {}, it will be synced "
+                     "again".format(item, entry['state']))
+            continue
+        region = entry['region']
+        try:
+            if region not in clients:
+                clients[region] = keystone_session.get_glanceclient(region)
+            image = clients[region].images.get(image_id)
+        except Exception as e:
+            if getattr(e, 'code', None) != 404:
+                log.warning("could not check image {} of interrupted item "
+                            "{}: {}".format(image_id, item, e))
+            continue
+        if (image['status'] == 'active' and
+                image.get('checksum') == entry.get('md5') and
+                str(image.get('size')) == str(entry.get('size'))):
+            log.info("image {} of interrupted item {} is complete, keeping "
+                     "it".format(image_id, item))
+            if image_index is not None:
+                image_index.invalidate(entry['content_id'], region)
+            continue
+        log.warning("deleting image {} ({}) of interrupted item {}".format(
+            image_id, image['status'], item))
+        try:
+            clients[region].images.delete(image_id)
+        except Exception:
+            log.exception("Exception deleting image {}:".format(image_id))
+    item_journal.reset()
+
+
+def version_tuple(version):
+    """'22.04' -> (22, 4), for comparing release versions."""
+    try:
+        return tuple(int(part) for part in str(version).split('.'))
+    except ValueError:
+        return ()
+
+
+# sync_priority rules: name -> (sort key of a flattened item, newest or
+# largest first).
+PRIORITY_RULES = {
+    'release': (lambda item: version_tuple(item.get('version')), True),
+    'lts': (lambda item: 'LTS' in item.get('release_title', ''), True),
+    'newest': (lambda item: item.get('version_name', ''), True),
+    'size': (lambda item: int(item.get('size') or 0), False),
+}
+
+
+def parse_priority_rules(rules):
+    """Parse a sync_priority string into a list of rules.
+
+    Each rule is either a name of PRIORITY_RULES or field=value, which
+    puts the items whose field has that value first.
+    """
+    parsed = (rules or '').replace(',', ' ').split()
+    for rule in parsed:
+        if '=' not in rule and rule not in PRIORITY_RULES:
+            raise ValueError("unknown sync_priority rule {!r}, expected one "
+                             "of {} or field=value".format(
+                                 rule, ', '.join(sorted(PRIORITY_RULES))))
+    return parsed
+
+
+def sort_by_priority(entries, rules, flat):
+    """Sort entries in place, most important first according to rules.
+
+    flat(entry) returns the flattened item of an entry. Ties keep their
+    order, which is the order simplestreams walks the products in.
+    """
+    # One stable sort per rule, least significant rule first.
+    for rule in reversed(rules):
+        if '=' in rule:
+            field, value = rule.split('=', 1)
+            entries.sort(key=lambda e: str(flat(e).get(field)) != value)
+        else:
+            key, reverse = PRIORITY_RULES[rule]
+            entries.sort(key=lambda e: key(flat(e)), reverse=reverse)
+
+
+def convert_image(path, disk_format, scratch_dir=None):
+    """Convert the image at path to disk_format with qemu-img.
+
+    Runs in a worker process of ImageConverter. Returns the path of the
+    converted image and its {'size', 'md5', 'sha256'}, or None when
+    qemu-img sees a raw file (which may not be a disk image at all) or the
+    image already is in disk_format.
+    """
+    info = json.loads(subprocess.check_output(
+        ['qemu-img', 'info', '--output=json', path]).decode('utf-8'))
+    source_format = info.get('format')
+    if source_format in (disk_format, 'raw'):
+        return None
+
+    fd, out_path = tempfile.mkstemp(prefix='gss-convert-', dir=scratch_dir)
+    os.close(fd)
+    try:
+        subprocess.check_call(['qemu-img', 'convert', '-f', source_format,
+                               '-O', disk_format, path, out_path])
+        hashers = dict((algo, hashlib.new(algo)) for algo in
+                       CONVERTED_CHECKSUMS)
+        with open(out_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CONVERT_READ_SIZE), b''):
+                for h in hashers.values():
+                    h.update(chunk)
+    except Exception:
+        os.unlink(out_path)
+        raise
+    info = dict((algo, h.hexdigest()) for algo, h in hashers.items())
+    info['size'] = str(os.path.getsize(out_path))
+    return out_path, info
+
+
+def set_converted_checksums(item, converted):
+    """Replace the size and checksums of item with the converted ones."""
+    for algo in CHECKSUM_ALGORITHMS:
+        item.pop(algo, None)
+    item.update(converted)
+
+
+class ImageConverter(object):
+    """Converts downloaded images in a pool of processes shared by all
+    mirrors, so conversions and their checksums run in parallel."""
+
+    def __init__(self, max_workers=IMAGE_CONVERT_WORKERS, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=max(int(max_workers or 1), 1))
+
+    def convert(self, path, disk_format):
+        """Return the path and checksums of path converted to disk_format,
+        or None when it is left as is, see convert_image()."""
+        return self._executor.submit(convert_image, path, disk_format,
+                                     self.scratch_dir).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class ProductsLedger(object):
+    """Items inserted and removed by the mirrors of a run.
+
+    Mirrors synced concurrently (see max_parallel_mirrors) publish the
+    same content_id, each from the target tree it loaded when it started.
+    Before a mirror writes its tree, merge() applies the changes of the
+    other mirrors to it, so the last writer does not drop them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (content_id, region) -> {pedigree: item, or None once removed}
+        self._changes = {}
+
+    def add(self, content_id, region, pedigree, item):
+        with self._lock:
+            self._changes.setdefault((content_id, region), {})[
+                tuple(pedigree)] = item
+
+    def remove(self, content_id, region, pedigree):
+        with self._lock:
+            self._changes.setdefault((content_id, region), {})[
+                tuple(pedigree)] = None
+
+    def merge(self, content_id, region, tree):
+        with self._lock:
+            changes = list(self._changes.get((content_id, region),
+                                             {}).items())
+        for pedigree, item in changes:
+            if item is not None:
+                products_set(tree, item, pedigree)
+                continue
+            (product, version, name) = pedigree
+            items = (tree.get('products', {}).get(product, {})
+                     .get('versions', {}).get(version, {}).get('items', {}))
+            if name in items:
+                products_del(tree, pedigree)
+
+
+class SyncPlan(object):
+    """What a mirror sync is going to do, computed before doing it."""
+
+    def __init__(self):
+        # pubname -> size, as expected by ProgressAggregator
+        self.items = {}
+        # (content_id, pedigree, flattened item data)
+        self.additions = []
+        self.removals = []
+        # content_id -> target tree loaded from glance while planning
+        self.targets = {}
+
+    @property
+    def total_bytes(self):
+        return sum(self.items.values())
+
+
+class DownloadMeter(object):
+    """Bytes the downloads of a sync read from upstream, and for how
+    long at least one of them was running."""
+
+    def __init__(self):
+        self.nbytes = 0
+        self.seconds = 0
+        self._running = 0
+        self._since = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if not self._running:
+                self._since = time.time()
+            self._running += 1
+
+    def stop(self):
+        with self._lock:
+            self._running -= 1
+            if not self._running:
+                self.seconds += time.time() - self._since
+
+    def add(self, nbytes):
+        with self._lock:
+            self.nbytes += nbytes
+
+
+class MeteredContentSource(contentsource.ContentSource):
+    """Content source counting what it reads from upstream in a
+    DownloadMeter, from its first read to its end or close(). What a
+    ResumableContentSource replays from its partial file is not counted.
+    """
+
+    def __init__(self, source, meter):
+        self.source = source
+        self.url = getattr(source, 'url', None)
+        self.meter = meter
+        self._started = False
+        self._stopped = False
+
+    def read(self, size=-1):
+        if not self._started:
+            self._started = True
+            self.meter.start()
+        replayed = getattr(self.source, 'replayed', 0)
+        buf = self.source.read(size)
+        self.meter.add(len(buf) -
+                       (getattr(self.source, 'replayed', 0) - replayed))
+        if size is None or size < 0 or len(buf) < size:
+            self._stop()
+        return buf
+
+    def _stop(self):
+        if self._started and not self._stopped:
+            self._stopped = True
+            self.meter.stop()
+
+    def close(self):
+        self._stop()
+        self.source.close()
+
+
+class ThroughputHistory(object):
+    """Moving average of the download throughput of past syncs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.bytes_per_second = json.load(f)['bytes_per_second']
+        except (IOError, OSError, ValueError, KeyError):
+            self.bytes_per_second = None
+
+    def estimate(self, nbytes):
+        """Return the seconds needed to download nbytes, or None."""
+        if not self.bytes_per_second:
+            return None
+        return nbytes / self.bytes_per_second
+
+    def record(self, nbytes, seconds):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            rate = nbytes / seconds
+            if self.bytes_per_second:
+                rate = (THROUGHPUT_WEIGHT * rate +
+                        (1 - THROUGHPUT_WEIGHT) * self.bytes_per_second)
+            self.bytes_per_second = rate
+            try:
+                atomic_write(self.path, json.dumps({'bytes_per_second': rate}))
+            except (IOError, OSError) as e:
+                log.warning("could not save throughput history: {}".format(
+                    e))
+
+
+def disk_free(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def glance_quota_remaining(gclient):
+    """Return how many bytes of images glance still accepts, or None when
+    it does not enforce or report a quota (before Yoga)."""
+    try:
+        usage = gclient.info.get_usage()
+        total = usage.get('usage', usage)['image_size_total']
+    except Exception:
+        return None
+    if total.get('limit') is None or total['limit'] < 0:
+        return None
+    # Unified limits are expressed in MiB.
+    return (total['limit'] - total.get('usage', 0)) * 1024 ** 2
+
+
+def preflight_check(mirror_url, charm_conf, max_parallel_items, plans,
+                    planners, throughput_history=None):
+    """Check that the planned sync of a mirror can complete.
+
+    Looks at the local disk the downloads are staged to, the glance quota
+    of each region and, with max_sync_duration, the time the downloads
+    take at the throughput of past syncs. Raises SyncDeferred when the
+    sync should not start, returns the number of bytes to download.
+    """
+    downloads = {}
+    for plan in plans.values():
+        for content_id, pedigree, item in plan.additions:
+            downloads[(content_id, pedigree)] = int(item.get('size') or 0)
+    download_bytes = sum(downloads.values())
+    log.info("pre-flight plan for {}: {} bytes to download, {} bytes to "
+             "upload to {} region(s)".format(
+                 mirror_url, download_bytes,
+                 sum(plan.total_bytes for plan in plans.values()),
+                 len(plans)))
+    if not downloads:
+        return 0
+
+    problems = []
+    # Images are staged whole to a temporary file unless they are streamed
+    # or imported, at most max_parallel_items at a time in each region.
+    # Converted images are always staged, and need more room than this
+    # once converted.
+    staged_dirs = []
+    if (charm_conf.get('disk_format') or
+            not (charm_conf.get('streaming_upload') or
+                 charm_conf.get('image_import_method'))):
+        staged_dirs.append(tempfile.gettempdir())
+    if charm_conf.get('resumable_downloads'):
+        staged_dirs.append(STATE_DIR)
+    staged = sum(
+        sum(sorted((int(item.get('size') or 0)
+                    for _, _, item in plan.additions),
+                   reverse=True)[:max_parallel_items])
+        for plan in plans.values())
+    needed = collections.OrderedDict((path, staged) for path in staged_dirs)
+    if len(plans) > 1:
+        # Items inserted in several regions are also spooled whole to a
+        # temporary file until the last region read them (see
+        # TeeTransfer), a region running ahead can leave all of them
+        # spooled at once.
+        regions = collections.Counter(
+            (content_id, pedigree) for plan in plans.values()
+            for content_id, pedigree, _ in plan.additions)
+        spooled = sum(size for key, size in downloads.items()
+                      if regions[key] > 1)
+        if spooled:
+            path = tempfile.gettempdir()
+            needed[path] = needed.get(path, 0) + spooled
+    for path, nbytes in needed.items():
+        free = disk_free(path) if os.path.isdir(path) else None
+        if free is not None and nbytes > free:
+            problems.append("{} bytes of disk needed in {}, {} free".format(
+                nbytes, path, free))
+
+    for region, planner in planners.items():
+        remaining = glance_quota_remaining(planner.gclient)
+        if remaining is not None and plans[region].total_bytes > remaining:
+            problems.append("{} bytes to upload to glance in {}, its quota "
+                            "allows {}".format(plans[region].total_bytes,
+                                               region, remaining))
+
+    max_duration = int(charm_conf.get('max_sync_duration') or 0) * 60
+    if max_duration and throughput_history is not None:
+        estimate = throughput_history.estimate(download_bytes)
+        if estimate is not None and estimate > max_duration:
+            problems.append("estimated to take {:.0f} minutes, over "
+                            "max_sync_duration".format(estimate / 60))
+
+    if problems:
+        raise SyncDeferred("sync of {} deferred: {}".format(
+            mirror_url, '; '.join(problems)))
+    return download_bytes
+
+
+class SyncPlanner(glance.ItemInfoDryRunMirror):
+    """Dry-run mirror recording a SyncPlan instead of touching glance."""
+
+    def __init__(self, config, objectstore, region=None, client=None,
+                 image_index=None):
+        self.image_index = image_index
+        if region is None and client is None:
+            super(SyncPlanner, self).__init__(config=config,
+                                              objectstore=objectstore)
+        else:
+            # ItemInfoDryRunMirror does not take a region or client, set it
+            # up the way it does on top of a GlanceMirror using them.
+            glance.GlanceMirror.__init__(self, config=config,
+                                         objectstore=objectstore,
+                                         region=region, client=client)
+            if hasattr(client, 'get_glanceclient'):
+                self.gclient = client.get_glanceclient(self.region)
+            self.items = {}
+        self.plan = SyncPlan()
+        self.plan.items = self.items
+
+    def load_products(self, path=None, content_id=None):
+        load = functools.partial(super(SyncPlanner, self).load_products,
+                                 path, content_id)
+        if self.image_index is not None:
+            target = indexed_load_products(self, self.image_index, load)
+        else:
+            target = load()
+        self.plan.targets[content_id] = copy.deepcopy(target)
+        return target
+
+    def insert_item(self, data, src, target, pedigree, contentsource):
+        super(SyncPlanner, self).insert_item(data, src, target, pedigree,
+                                             contentsource)
+        self.plan.additions.append((src['content_id'], pedigree,
+                                    products_exdata(src, pedigree)))
+
+    def remove_item(self, data, src, target, pedigree):
+        self.plan.removals.append((src['content_id'], pedigree, data))
+
+
 class GlanceMirrorWithCustomProperties(glance.GlanceMirror):
+    # Mirrors may be synced concurrently (see max_parallel_mirrors) and they
+    # all publish into the same product-streams store, whose products files
+    # and index are updated with a read-modify-write cycle, see
+    # ProductsLedger.
+    _store_lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
         custom_properties = kwargs.pop('custom_properties', {})
+        max_parallel_items = kwargs.pop('max_parallel_items', 1)
+        plan = kwargs.pop('plan', None)
+        mirror_url = kwargs.pop('mirror_url', None)
+        resumable_downloads = kwargs.pop('resumable_downloads', False)
+        blob_cache = kwargs.pop('blob_cache', None)
+        transfer_hub = kwargs.pop('transfer_hub', None)
+        streaming_upload = kwargs.pop('streaming_upload', False)
+        image_import_method = kwargs.pop('image_import_method', None)
+        rate_limiters = kwargs.pop('rate_limiters', [])
+        priority_rules = kwargs.pop('priority_rules', [])
+        image_index = kwargs.pop('image_index', None)
+        products_ledger = kwargs.pop('products_ledger', None)
+        max_parallel_deletes = kwargs.pop('max_parallel_deletes', 1)
+        item_journal = kwargs.pop('item_journal', None)
+        disk_format = kwargs.pop('disk_format', None)
+        image_converter = kwargs.pop('image_converter', None)
+        download_meter = kwargs.pop('download_meter', None)
         super(GlanceMirrorWithCustomProperties, self).__init__(*args, **kwargs)
+        if hasattr(kwargs.get('client'), 'get_glanceclient'):
+            # See KeystoneSession.get_service_conn_info().
+            self.gclient = kwargs['client'].get_glanceclient(self.region)
         self.custom_properties = custom_properties
+        self.plan = plan
+        self.mirror_url = mirror_url
+        self.resumable_downloads = resumable_downloads
+        self.blob_cache = blob_cache
+        self.transfer_hub = transfer_hub
+        self.streaming_upload = streaming_upload
+        self.image_import_method = image_import_method
+        self.rate_limiters = rate_limiters
+        self.priority_rules = priority_rules
+        self.image_index = image_index
+        self.products_ledger = products_ledger
+        self.max_parallel_deletes = max(int(max_parallel_deletes or 1), 1)
+        self._pending_removals = []
+        self._syncing = False
+        self.item_journal = item_journal
+        self.disk_format = disk_format
+        self.image_converter = image_converter if disk_format else None
+        self.download_meter = download_meter
+        self._deferred_items = []
+        self.max_parallel_items = max(int(max_parallel_items or 1), 1)
+        self._executor = None
+        self._pending_items = []
+        self._local = threading.local()
+        self.gclient.images = GlanceImagesProxy(
+            self.gclient.images, self._local, importer=self._import_image,
+            on_create=functools.partial(self._journal_item, 'uploading'))
+        self._import_supported = None
+
+    def sync(self, reader, path):
+        # sync() recurses from an index into its products files, only the
+        # outermost call owns the item pipeline and the image deletions.
+        if self._syncing:
+            return (super(GlanceMirrorWithCustomProperties, self)
+                    .sync(reader, path))
+
+        self._syncing = True
+        if self.max_parallel_items > 1:
+            log.info("inserting up to {} items concurrently".format(
+                self.max_parallel_items))
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=self.max_parallel_items)
+        try:
+            result = (super(GlanceMirrorWithCustomProperties, self)
+                      .sync(reader, path))
+        except Exception:
+            # The images stay in glance but are no longer published, the
+            # next sync removes them again.
+            self._pending_removals = []
+            raise
+        finally:
+            self._syncing = False
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            self._pending_items = []
+        self._prune_images()
+        return result
+
+    def load_products(self, path=None, content_id=None):
+        # The planning pass already listed glance for this content_id.
+        if self.plan is not None and content_id in self.plan.targets:
+            return self.plan.targets.pop(content_id)
+        load = functools.partial(
+            super(GlanceMirrorWithCustomProperties, self).load_products,
+            path, content_id)
+        if self.image_index is not None:
+            return indexed_load_products(self, self.image_index, load)
+        return load()
+
+    def _record_item(self, pedigree, item):
+        """Record an inserted item in the image index and the ledger."""
+        if self.image_index is not None:
+            self.image_index.add(self.config['content_id'], self.region,
+                                 pedigree, item)
+        if self.products_ledger is not None:
+            self.products_ledger.add(self.config['content_id'], self.region,
+                                     pedigree, item)
+
+    def remove_item(self, data, src, target, pedigree):
+        # Unpublished right away, but the glance image is only deleted by
+        # _prune_images() once the new images are in.
+        products_del(target, pedigree)
+        if self.products_ledger is not None:
+            self.products_ledger.remove(self.config['content_id'],
+                                        self.region, pedigree)
+        if 'id' in data:
+            self._pending_removals.append((pedigree, data))
+        elif self.image_index is not None:
+            self.image_index.remove(self.config['content_id'], self.region,
+                                    pedigree)
+
+    def _prune_images(self):
+        """Delete the images of the removed items, in parallel."""
+        removals, self._pending_removals = self._pending_removals, []
+        if not removals:
+            return
+        log.info("deleting {} expired images in {}, {} at a time".format(
+            len(removals), self.region, self.max_parallel_deletes))
+        reclaimed = 0
+        failed = 0
+        with futures.ThreadPoolExecutor(
+                max_workers=self.max_parallel_deletes) as pool:
+            jobs = dict((pool.submit(self._delete_image, data), (pedigree,
+                                                                 data))
+                        for pedigree, data in removals)
+            for job in futures.as_completed(jobs):
+                pedigree, data = jobs[job]
+                try:
+                    job.result()
+                except Exception:
+                    log.exception("Exception deleting image {} of {}:".format(
+                        data['id'], '/'.join(pedigree)))
+                    failed += 1
+                    continue
+                reclaimed += int(data.get('size') or 0)
+                if self.image_index is not None:
+                    self.image_index.remove(self.config['content_id'],
+                                            self.region, pedigree)
+        log.info("deleted {} expired images in {}, reclaimed {} bytes, "
+                 "{} failed".format(len(removals) - failed, self.region,
+                                    reclaimed, failed))
+
+    def _delete_image(self, data):
+        for attempt in range(IMAGE_DELETE_ATTEMPTS):
+            if attempt:
+                time.sleep(IMAGE_DELETE_RETRY_DELAY * 2 ** (attempt - 1))
+            log.info("removing {}: {}".format(data['id'], data.get('name')))
+            try:
+                self.gclient.images.delete(data['id'])
+                return
+            except Exception as e:
+                if getattr(e, 'code', None) == 404:
+                    log.info("image {} is already gone".format(data['id']))
+                    return
+                if attempt + 1 == IMAGE_DELETE_ATTEMPTS:
+                    raise
+                log.warning("deleting image {} failed, retrying: {}".format(
+                    data['id'], e))
+
+    def wrap_contentsource(self, src, pedigree, contentsource):
+        """Return the content source to read the item of pedigree from."""
+        flat = products_exdata(src, pedigree)
+        if self.transfer_hub is None:
+            return self._item_source(flat, contentsource)
+
+        opened = []
+
+        def open_upstream():
+            opened.append(True)
+            return self._item_source(flat, contentsource)
+
+        source = self.transfer_hub.source((src['content_id'], pedigree),
+                                          open_upstream)
+        if not opened:
+            # Another region is already downloading it.
+            contentsource.close()
+        return source
+
+    def _item_source(self, flat, contentsource):
+        sha256 = flat.get('sha256') if self.blob_cache is not None else None
+        if sha256:
+            path = self.blob_cache.lookup(sha256)
+            if path:
+                log.info("using cached blob for {}".format(flat.get('path')))
+                contentsource.close()
+                return CachedBlobContentSource(self.blob_cache, path, sha256)
+
+        url = None
+        if self.mirror_url and flat.get('path'):
+            url = self.mirror_url + flat['path']
+
+        if (self.resumable_downloads and url and
+                url.startswith(('http://', 'https://'))):
+            ensure_state_dir(PARTIAL_DOWNLOAD_DIR)
+            contentsource.close()
+            contentsource = ResumableContentSource(
+                url, PARTIAL_DOWNLOAD_DIR, size=flat.get('size'),
+                checksums=item_checksums(flat))
+
+        if self.download_meter is not None:
+            contentsource = MeteredContentSource(contentsource,
+                                                 self.download_meter)
+
+        if self.rate_limiters:
+            contentsource = RateLimitedContentSource(contentsource,
+                                                     self.rate_limiters)
+
+        if sha256:
+            contentsource = BlobCacheFillingContentSource(
+                contentsource, self.blob_cache, sha256)
+        return contentsource
+
+    def insert_item(self, data, src, target, pedigree, contentsource):
+        if self.priority_rules:
+            # Dispatched by insert_products(), once all the items of the
+            # products file are known.
+            self._deferred_items.append((data, src, target, pedigree,
+                                         contentsource))
+            return
+        self._dispatch_item(data, src, target, pedigree, contentsource)
+
+    def _dispatch_deferred_items(self):
+        deferred, self._deferred_items = self._deferred_items, []
+        sort_by_priority(deferred, self.priority_rules,
+                         lambda d: products_exdata(d[1], d[3]))
+        if deferred:
+            log.info("syncing {} items in priority order: {}".format(
+                len(deferred), ', '.join('/'.join(d[3]) for d in deferred)))
+        for entry in deferred:
+            self._dispatch_item(*entry)
+
+    def _journal_item(self, state, image_id=None, pedigree=None, flat=None):
+        """Record a state change of the item this thread is inserting."""
+        if self.item_journal is None:
+            return
+        if pedigree is None:
+            pedigree, flat = self._local.journal_item
+        self.item_journal.record(
+            self.region, self.config['content_id'], pedigree, state,
+            image_id=image_id, md5=flat.get('md5'), size=flat.get('size'))
+
+    def _dispatch_item(self, data, src, target, pedigree, contentsource):
+        self._journal_item('planned', pedigree=pedigree,
+                           flat=products_exdata(src, pedigree))
+        if contentsource is not None:
+            contentsource = self.wrap_contentsource(src, pedigree,
+                                                    contentsource)
+
+        if self._executor is None:
+            self._insert_item(data, src, target, pedigree, contentsource)
+            (product, version, item) = pedigree
+            self._record_item(pedigree, target['products'][product]
+                              ['versions'][version]['items'][item])
+            return
+
+        job = self._executor.submit(self._insert_item_job, data, src, target,
+                                    pedigree, contentsource)
+        self._pending_items.append((job, target, pedigree))
+
+    def _insert_item_job(self, data, src, target, pedigree, contentsource):
+        """Download and upload one item from a worker thread.
+
+        The item is recorded in a private copy of the target tree, it is
+        merged into the shared one by _drain_items() from the thread
+        running sync().
+        """
+        scratch = dict((k, v) for k, v in target.items() if k != 'products')
+        scratch['products'] = {}
+        self._local.scratch = True
+        try:
+            self._insert_item(data, src, scratch, pedigree, contentsource)
+        finally:
+            self._local.scratch = False
+        (product, version, item) = pedigree
+        return scratch['products'][product]['versions'][version]['items'][item]
+
+    def _insert_item(self, data, src, target, pedigree, contentsource):
+        """GlanceMirror.insert_item(), cleaning up after a failed upload."""
+        self._local.created_image_id = None
+        self._local.stream = None
+        self._local.import_uri = None
+        self._local.disk_format = None
+        self._local.converted = None
+        self._local.journal_item = (pedigree, products_exdata(src, pedigree))
+        self._journal_item('downloading')
+        try:
+            (super(GlanceMirrorWithCustomProperties, self)
+             .insert_item(data, src, target, pedigree, contentsource))
+            error = None
+        except Exception as e:
+            error = e
+
+        stream = self._local.stream
+        if stream is not None:
+            # A verification failure explains any upload error better.
+            error = stream.finish() or error
+
+        if error is None and self._local.converted:
+            (product, version, item) = pedigree
+            set_converted_checksums(
+                target['products'][product]['versions'][version]['items']
+                [item], self._local.converted)
+
+        if error is not None:
+            image_id = self._local.created_image_id
+            if image_id:
+                log.warning("deleting image {} after failed insert of "
+                            "{}".format(image_id, '/'.join(pedigree)))
+                try:
+                    self.gclient.images.delete(image_id)
+                except Exception:
+                    log.exception("Exception deleting image {}:".format(
+                        image_id))
+            self._journal_item('failed', image_id=image_id)
+            raise error
+        self._journal_item('active', image_id=self._local.created_image_id)
+
+    def _import_uri(self, image_stream_data):
+        """Return the URL glance should import the item from, or None."""
+        if (not self.image_import_method or self.modify_hook or
+                not self.mirror_url or not image_stream_data.get('path') or
+                not image_stream_data.get('md5') or
+                image_stream_data.get('size') is None):
+            # validate_image() needs the md5 glance computes to check the
+            # imported image.
+            return None
+        url = self.mirror_url + image_stream_data['path']
+        if not url.startswith(('http://', 'https://')):
+            return None
+
+        if self._import_supported is None:
+            self._import_supported = False
+            if self.glance_api_version == "2":
+                try:
+                    info = self.gclient.images.get_import_info()
+                    methods = info.get('import-methods', {}).get('value', [])
+                    self._import_supported = (self.image_import_method in
+                                              methods)
+                except Exception as e:
+                    log.warning("could not query glance import methods: "
+                                "{}".format(e))
+            if not self._import_supported:
+                log.info("glance does not offer the {} import method, "
+                         "uploading images instead".format(
+                             self.image_import_method))
+        return url if self._import_supported else None
+
+    def _import_image(self, image_id, uri):
+        """Have glance fetch uri into image_id and wait until it is active.
+
+        The checksum and size glance computed are checked afterwards by
+        GlanceMirror.validate_image().
+        """
+        log.info("importing {} into image {} with {}".format(
+            uri, image_id, self.image_import_method))
+        self.gclient.images.image_import(image_id,
+                                         method=self.image_import_method,
+                                         uri=uri)
+        deadline = time.time() + IMAGE_IMPORT_TIMEOUT
+        while True:
+            image = self.gclient.images.get(image_id)
+            status = image['status']
+            if status == 'active':
+                return
+            if (status in ('killed', 'deleted') or
+                    image.get('os_glance_failed_import')):
+                raise IOError("import of {} into image {} failed (status "
+                              "{})".format(uri, image_id, status))
+            if time.time() > deadline:
+                raise IOError("import of {} into image {} timed out (status "
+                              "{})".format(uri, image_id, status))
+            time.sleep(IMAGE_IMPORT_POLL_INTERVAL)
+
+    def _convert_image(self, downloaded, image_stream_data):
+        """Convert a downloaded image to disk_format.
+
+        The size and checksums of the converted image replace the ones of
+        the download, for glance, the item journal and the published item
+        alike.
+        """
+        path = downloaded[0]
+        name = image_stream_data.get('pubname')
+        log.info("converting {} to {}".format(name, self.disk_format))
+        try:
+            converted = self.image_converter.convert(path, self.disk_format)
+        except Exception:
+            os.unlink(path)
+            raise
+        if converted is None:
+            return downloaded
+        os.unlink(path)
+        converted_path, checksums = converted
+        log.info("converted {} to {}, {} bytes".format(
+            name, self.disk_format, checksums['size']))
+        self._local.disk_format = self.disk_format
+        self._local.converted = checksums
+        pedigree, flat = self._local.journal_item
+        flat = dict(flat)
+        set_converted_checksums(flat, checksums)
+        self._local.journal_item = (pedigree, flat)
+        return converted_path, int(checksums['size']), checksums['md5']
+
+    def download_image(self, contentsource, image_stream_data):
+        if self.image_converter is not None:
+            # Images are converted from a local copy, neither imported nor
+            # streamed.
+            return self._convert_image(
+                (super(GlanceMirrorWithCustomProperties, self)
+                 .download_image(contentsource, image_stream_data)),
+                image_stream_data)
+
+        import_uri = self._import_uri(image_stream_data)
+        if import_uri:
+            # glance fetches the image itself, GlanceMirror only needs a
+            # file to open, see GlanceImagesProxy.upload().
+            contentsource.close()
+            self._local.import_uri = import_uri
+            fd, path = tempfile.mkstemp(prefix='gss-import-')
+            os.close(fd)
+            size = int(image_stream_data['size'])
+            if self.progress_callback:
+                self.progress_callback(dict(
+                    status="Importing", name=image_stream_data.get('pubname'),
+                    size=size, written=size))
+            return path, size, image_stream_data.get('md5')
+
+        if (not self.streaming_upload or self.modify_hook or
+                image_stream_data.get('size') is None):
+            return (super(GlanceMirrorWithCustomProperties, self)
+                    .download_image(contentsource, image_stream_data))
+
+        name = image_stream_data.get('pubname')
+        size = int(image_stream_data['size'])
+
+        def progress(written):
+            if self.progress_callback:
+                self.progress_callback(dict(status="Downloading", name=name,
+                                            size=size, written=written))
+
+        verifier = StreamingVerifier(contentsource, size=size,
+                                     checksums=item_checksums(
+                                         image_stream_data),
+                                     progress=progress)
+        stream = self._local.stream = ImageStream(verifier)
+        log.info("streaming {} to glance".format(name))
+        return stream.path, size, image_stream_data.get('md5')
+
+    def _drain_items(self):
+        """Wait for in-flight items and merge them into their target."""
+        pending, self._pending_items = self._pending_items, []
+        error = None
+        for job, target, pedigree in pending:
+            try:
+                item = job.result()
+            except Exception as e:
+                log.exception("Exception inserting {}:".format(
+                    '/'.join(pedigree)))
+                error = error or e
+                continue
+            products_set(target, item, pedigree)
+            self._record_item(pedigree, item)
+        if error is not None:
+            raise error
 
     def prepare_glance_arguments(self, *args, **kwargs):
 
@@ -130,41 +2572,194 @@ class GlanceMirrorWithCustomProperties(glance.GlanceMirror):
             props.update(self.custom_properties)
             glance_args['properties'] = props
 
+        if getattr(self._local, 'disk_format', None):
+            glance_args['disk_format'] = self._local.disk_format
+        converted = getattr(self._local, 'converted', None)
+        if converted:
+            # The stream metadata kept with the image describes the
+            # uploaded, converted, file.
+            props = glance_args.get('properties', glance_args)
+            if props.get('simplestreams_metadata'):
+                metadata = json.loads(props['simplestreams_metadata'])
+                set_converted_checksums(metadata, converted)
+                props['simplestreams_metadata'] = json.dumps(
+                    metadata, sort_keys=True)
+
         return glance_args
 
+    def insert_products(self, path, target, content):
+        if getattr(self._local, 'scratch', False):
+            # Worker threads do not publish their private tree.
+            return
+        self._dispatch_deferred_items()
+        self._drain_items()
+        with self._store_lock:
+            if self.store is not None and self.products_ledger is not None:
+                self.products_ledger.merge(self.config['content_id'],
+                                           self.region, target)
+            return (super(GlanceMirrorWithCustomProperties, self)
+                    .insert_products(path, target, content))
+
 
 class StatusMessageProgressAggregator(ProgressAggregator):
-    def __init__(self, remaining_items, send_status_message):
+    """Publishes sync progress as status messages.
+
+    The first and last message of each file are always sent. In between,
+    a message is only sent when the file progressed by min_step (a
+    fraction of its size) and no message was sent for min_interval
+    seconds, so publishing does not hold back the transfers.
+    """
+
+    def __init__(self, remaining_items, send_status_message,
+                 min_interval=PROGRESS_MIN_INTERVAL,
+                 min_step=PROGRESS_MIN_STEP):
         super(StatusMessageProgressAggregator, self).__init__(remaining_items)
         self.send_status_message = send_status_message
+        self.min_interval = min_interval
+        self.min_step = min_step
+        # Items may be transferred concurrently (see max_parallel_items),
+        # so progress is tracked per file name instead of assuming that
+        # files are written one after another.
+        self._lock = threading.Lock()
+        self._written = {}
+        self._emitted = {}
+        self._last_emit = 0
+        self._started_at = None
+
+    def progress_callback(self, progress):
+        with self._lock:
+            name = progress['name']
+            size = float(progress['size'])
+            started = name not in self._written
+            written = self._written.get(name, 0) + progress['written']
+            self._written[name] = written
+            self.total_written += progress['written']
+
+            done = written >= size
+            if done and self.remaining_items:
+                self.remaining_items.pop(name, None)
+
+            now = time.time()
+            if self._started_at is None:
+                self._started_at = now
+            if not (started or done or
+                    (written - self._emitted.get(name, 0) >=
+                     size * self.min_step and
+                     now - self._last_emit >= self.min_interval)):
+                return
+            self._emitted[name] = written
+            self._last_emit = now
+            msg = self.format_message(dict(progress, written=written))
+        # Published outside of the lock, other transfers keep reporting
+        # progress meanwhile.
+        self.send_status_message(dict(status="Syncing", message=msg))
 
     def emit(self, progress):
+        self.send_status_message(dict(status="Syncing",
+                                      message=self.format_message(progress)))
+
+    def format_message(self, progress):
         size = float(progress['size'])
         written = float(progress['written'])
-        cur = self.total_image_count - len(self.remaining_items) + 1
+        cur = min(self.total_image_count - len(self.remaining_items) + 1,
+                  self.total_image_count)
         totpct = float(self.total_written) / self.total_size
-        msg = "{name} {filepct:.0%}\n"\
-              "({cur} of {tot} images) total: "\
-              "{totpct:.0%}".format(name=progress['name'],
-                                    filepct=(written / size),
-                                    cur=cur,
-                                    tot=self.total_image_count,
-                                    totpct=totpct)
-        self.send_status_message(dict(status="Syncing",
-                                      message=msg))
+        elapsed = time.time() - (self._started_at or time.time())
+        rate = self.total_written / elapsed if elapsed > 0 else 0
+        return "{name} {filepct:.0%}\n"\
+               "({cur} of {tot} images) total: "\
+               "{totpct:.0%} at {rate:.1f} Mbit/s".format(
+                   name=progress['name'],
+                   filepct=(written / size),
+                   cur=cur,
+                   tot=self.total_image_count,
+                   totpct=totpct,
+                   rate=rate * 8 / 1000 / 1000)
+
+
+class SignatureCache(object):
+    """Digests of signed files that gpg already verified.
+
+    Entries are only valid for the keyring they were verified against, a
+    change of the keyring content or mtime discards all of them.
+    """
 
+    def __init__(self, path, keyring):
+        self.path = path
+        self.keyring = keyring
+        self.keyring_id = self._keyring_id()
+        self.digests = {}
+        self._dirty = False
+        self._lock = threading.Lock()
 
-def policy(content, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = {}
+        if data.get('keyring') == self.keyring_id:
+            self.digests = data.get('digests', {})
+        elif data:
+            log.info("keyring {} changed, discarding signature "
+                     "cache".format(keyring))
+            self._dirty = True
+
+    def _keyring_id(self):
+        with open(self.keyring, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return '{}:{}'.format(digest, int(os.path.getmtime(self.keyring)))
+
+    def read_signed(self, content):
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if digest in self.digests:
+            # Already verified, only strip the signature.
+            return read_signed(content, keyring=self.keyring, checked=False)
+
+        ret = read_signed(content, keyring=self.keyring)
+        with self._lock:
+            self.digests[digest] = time.time()
+            self._dirty = True
+        return ret
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            digests = sorted(self.digests.items(), key=lambda d: d[1])
+            data = {'keyring': self.keyring_id,
+                    'digests': dict(digests[-SIGNATURE_CACHE_MAX_ENTRIES:])}
+            atomic_write(self.path, json.dumps(data), mode=0o600)
+            self._dirty = False
+
+
+def policy(content, path, signature_cache=None):
     if path.endswith('sjson'):
+        if signature_cache is not None:
+            return signature_cache.read_signed(content)
         return read_signed(content, keyring=KEYRING)
     else:
         return content
 
 
+_conf_cache = {}
+_conf_cache_lock = threading.Lock()
+
+
 def read_conf(filename):
-    with open(filename) as f:
-        confobj = yaml.load(f)
-    return confobj
+    """Return the parsed content of filename.
+
+    The file is only parsed again once its mtime or size changes, callers
+    get their own copy of the content.
+    """
+    st = os.stat(filename)
+    key = (st.st_mtime, st.st_size)
+    with _conf_cache_lock:
+        cached = _conf_cache.get(filename)
+        if cached is None or cached[0] != key:
+            with open(filename) as f:
+                confobj = yaml.load(f)
+            cached = _conf_cache[filename] = (key, confobj)
+    return copy.deepcopy(cached[1])
 
 
 def redact_keys(data_dict, key_list=None):
@@ -223,30 +2818,142 @@ def get_conf():
     return id_conf, charm_conf
 
 
-def get_keystone_client(api_version):
+class KeystoneSession(object):
+    """keystoneauth session shared by the keystone, glance and swift clients.
+
+    The token is kept in a root only state file and reused by the following
+    runs until it expires, so that most runs do not authenticate with the
+    password at all. An instance also stands in for simplestreams'
+    openstack module as the client of GlanceMirror.
+    """
+
+    def __init__(self, api_version, state_file=AUTH_STATE_FILE):
+        if api_version == 3:
+            self.auth = ks_identity.v3.Password(
+                auth_url=os.environ['OS_AUTH_URL'],
+                username=os.environ['OS_USERNAME'],
+                password=os.environ['OS_PASSWORD'],
+                user_domain_name=os.environ['OS_USER_DOMAIN_NAME'],
+                project_domain_name=os.environ['OS_PROJECT_DOMAIN_NAME'],
+                project_name=os.environ['OS_PROJECT_NAME'],
+                project_id=os.environ['OS_PROJECT_ID'])
+        else:
+            self.auth = ks_identity.v2.Password(
+                auth_url=os.environ['OS_AUTH_URL'],
+                username=os.environ['OS_USERNAME'],
+                password=os.environ['OS_PASSWORD'],
+                tenant_id=os.environ['OS_TENANT_ID'],
+                tenant_name=os.environ['OS_TENANT_NAME'])
+        self.cacert = None
+        os_cacert = os.environ.get('OS_CACERT', None)
+        if (os.environ['OS_AUTH_URL'].startswith('https') and
+                os_cacert is not None):
+            self.cacert = os_cacert
+        self.session = ks_session.Session(auth=self.auth,
+                                          verify=self.cacert or True)
+        self.interface = os.environ.get('OS_INTERFACE', 'public')
+        self.state_file = state_file
+        self._saved_state = None
+        self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        # The state is only valid for the credentials it was issued to.
+        if data.get('cache_id') != self.auth.get_cache_id():
+            return
+        try:
+            self.auth.set_auth_state(data['state'])
+            self._saved_state = data['state']
+            log.info("reusing keystone token from {}".format(
+                self.state_file))
+        except Exception as e:
+            log.warning("could not reuse keystone token: {}".format(e))
+
+    def save_state(self):
+        """Persist the current token if it changed since it was loaded."""
+        state = self.auth.get_auth_state()
+        if not state or state == self._saved_state:
+            return
+        data = {'cache_id': self.auth.get_cache_id(), 'state': state}
+        atomic_write(self.state_file, json.dumps(data), mode=0o600)
+        self._saved_state = state
+
+    def load_keystone_creds(self):
+        """Credentials as returned by
+        simplestreams.openstack.load_keystone_creds().
+
+        GlanceMirror passes them back to get_service_conn_info() and reads
+        auth_url and region_name from them, authentication itself goes
+        through the session.
+        """
+        creds = {'auth_url': os.environ['OS_AUTH_URL'],
+                 'region_name': os.environ.get('OS_REGION_NAME'),
+                 'insecure': False}
+        if self.cacert:
+            creds['cacert'] = self.cacert
+        return creds
+
+    def endpoint(self, service_type, interface=None, region_name=None):
+        interface = interface or self.interface
+        region_name = region_name or os.environ.get('OS_REGION_NAME')
+        url = self.session.get_endpoint(service_type=service_type,
+                                        interface=interface,
+                                        region_name=region_name)
+        if not url:
+            raise keystone_exceptions.EndpointNotFound(
+                "{} endpoint for {} service in {} region not found".format(
+                    interface, service_type, region_name))
+        return url
+
+    def get_service_conn_info(self, service_type, **kwargs):
+        """Connection info for service_type, as returned by
+        simplestreams.openstack.get_service_conn_info().
+
+        The session is deliberately left out: simplestreams'
+        get_glanceclient() would build its client from it and ignore the
+        endpoint of the region. The client it builds from this info uses
+        a token that is never renewed, mirrors replace it with one from
+        get_glanceclient().
+        """
+        region_name = kwargs.get('region_name')
+        info = {'endpoint': self.endpoint(service_type,
+                                          region_name=region_name),
+                'token': self.session.get_token(),
+                'tenant_id': self.session.get_project_id(),
+                'insecure': False,
+                'cacert': self.cacert,
+                'region_name': region_name}
+        if service_type == 'image':
+            info['glance_version'] = self.glance_version()
+        return info
+
+    @staticmethod
+    def glance_version():
+        return os.environ.get('OS_IMAGE_API_VERSION', '2')
+
+    def get_glanceclient(self, region_name=None):
+        """Return a glance client of region_name using the session.
+
+        The session authenticates again when the token is about to expire,
+        so long syncs do not fail halfway with expired tokens.
+        """
+        return glanceclient.Client(
+            self.glance_version(), session=self.session,
+            region_name=region_name or os.environ.get('OS_REGION_NAME'),
+            interface=self.interface)
+
+
+def get_keystone_client(api_version, keystone_session):
     if api_version == 3:
-        ksc_vars = dict(
-            auth_url=os.environ['OS_AUTH_URL'],
-            username=os.environ['OS_USERNAME'],
-            password=os.environ['OS_PASSWORD'],
-            user_domain_name=os.environ['OS_USER_DOMAIN_NAME'],
-            project_domain_name=os.environ['OS_PROJECT_DOMAIN_NAME'],
-            project_name=os.environ['OS_PROJECT_NAME'],
-            project_id=os.environ['OS_PROJECT_ID'])
         ksc_class = keystone_v3_client.Client
     else:
-        ksc_vars = dict(
-            username=os.environ['OS_USERNAME'],
-            password=os.environ['OS_PASSWORD'],
-            tenant_id=os.environ['OS_TENANT_ID'],
-            tenant_name=os.environ['OS_TENANT_NAME'],
-            auth_url=os.environ['OS_AUTH_URL'])
         ksc_class = keystone_client.Client
-    os_cacert = os.environ.get('OS_CACERT', None)
-    if (os.environ['OS_AUTH_URL'].startswith('https') and
-            os_cacert is not None):
-        ksc_vars['cacert'] = os_cacert
-    return ksc_class(**ksc_vars)
+    return ksc_class(session=keystone_session.session,
+                     interface=keystone_session.interface)
 
 
 def set_openstack_env(id_conf, charm_conf):
@@ -283,75 +2990,335 @@ def set_openstack_env(id_conf, charm_conf):
         os.environ['OS_TENANT_NAME'] = id_conf['admin_tenant_name']
 
 
-def do_sync(charm_conf, status_exchange):
-
-    # NOTE(beisner): the user_agent variable was an unused assignment (lint).
-    # It may be worth re-visiting its usage, intent and benefit with the
-    # UrlMirrorReader call below at some point.  Leaving it disabled for now,
-    # and not assigning it since it is not currently utilized.
-    # user_agent = charm_conf.get("user_agent")
-
-    for mirror_info in charm_conf['mirror_list']:
-        mirror_url, initial_path = path_from_mirror_url(mirror_info['url'],
-                                                        mirror_info['path'])
-
-        log.info("configuring sync for url {}".format(mirror_info))
-
-        smirror = UrlMirrorReader(
-            mirror_url, policy=policy)
-
-        if charm_conf['use_swift']:
-            store = SwiftObjectStore(SWIFT_DATA_DIR)
-        else:
-            # Use the local apache server to serve product streams
-            store = FileStore(prefix=APACHE_DATA_DIR)
-
-        content_id = charm_conf['content_id_template'].format(
-            region=charm_conf['region'])
-
-        config = {'max_items': mirror_info['max'],
-                  'modify_hook': charm_conf['modify_hook_scripts'],
-                  'keep_items': True,
-                  'content_id': content_id,
-                  'cloud_name': charm_conf['cloud_name'],
-                  'item_filters': mirror_info['item_filters'],
-                  'hypervisor_mapping': charm_conf.get('hypervisor_mapping',
-                                                       False)}
-
-        mirror_args = dict(config=config, objectstore=store,
-                           name_prefix=charm_conf['name_prefix'])
-        mirror_args['custom_properties'] = charm_conf.get('custom_properties',
-                                                          False)
-
-        if SIMPLESTREAMS_HAS_PROGRESS:
-            log.info("Calling DryRun mirror to get item list")
-
-            drmirror = glance.ItemInfoDryRunMirror(config=config,
-                                                   objectstore=store)
-            drmirror.sync(smirror, path=initial_path)
-            p = StatusMessageProgressAggregator(drmirror.items,
-                                                status_exchange.send_message)
-            mirror_args['progress_callback'] = p.progress_callback
-        else:
-            log.info("Detected simplestreams version without progress"
-                     " update support. Only limited feedback available.")
-
-        tmirror = GlanceMirrorWithCustomProperties(**mirror_args)
-
-        log.info("calling GlanceMirror.sync")
-        tmirror.sync(smirror, path=initial_path)
-
-
-def update_product_streams_service(ksc, services, region):
+def sync_mirror(charm_conf, mirror_info, status_exchange,
+                metadata_cache=None, signature_cache=None, blob_cache=None,
+                keystone_session=None, bandwidth_limiter=None,
+                image_index=None, item_journal=None,
+                throughput_history=None, image_converter=None,
+                products_ledger=None):
+    """Sync a single entry of charm_conf['mirror_list'] into glance.
+
+    Glance and swift clients authenticate with keystone_session when it is
+    set, instead of on their own. Downloads are throttled by the
+    bandwidth_limiter TokenBucket shared by all mirrors, and by the
+    mirror's own bandwidth_limit. Already synced images are looked up in
+    image_index, a SyncedImageIndex, when it is set. Images are converted
+    to the mirror's disk_format by image_converter. The mirrors synced at
+    the same time share products_ledger, a ProductsLedger.
+    """
+    mirror_url, initial_path = path_from_mirror_url(mirror_info['url'],
+                                                    mirror_info['path'])
+
+    log.info("configuring sync for url {}".format(mirror_info))
+
+    mirror_policy = functools.partial(policy,
+                                      signature_cache=signature_cache)
+    user_agent = charm_conf.get('user_agent')
+    if metadata_cache is not None:
+        smirror = ConditionalUrlMirrorReader(
+            mirror_url, metadata_cache, policy=mirror_policy,
+            user_agent=user_agent)
+    else:
+        smirror = PooledUrlMirrorReader(
+            mirror_url, policy=mirror_policy, user_agent=user_agent)
+    smirror = CachingMirrorReader(smirror)
+
+    if charm_conf['use_swift']:
+        store = SegmentedSwiftObjectStore(
+            SWIFT_DATA_DIR,
+            segment_size=int(charm_conf.get('swift_segment_size', 0)) *
+            1024 ** 2,
+            segment_workers=charm_conf.get('swift_segment_workers', 1),
+            keystone_session=keystone_session)
+    else:
+        # Use the local apache server to serve product streams
+        store = FileStore(prefix=APACHE_DATA_DIR)
+
+    content_id = charm_conf['content_id_template'].format(
+        region=charm_conf['region'])
+
+    config = {'max_items': mirror_info['max'],
+              'modify_hook': charm_conf['modify_hook_scripts'],
+              'keep_items': True,
+              'content_id': content_id,
+              'cloud_name': charm_conf['cloud_name'],
+              'item_filters': mirror_info['item_filters'],
+              'hypervisor_mapping': charm_conf.get('hypervisor_mapping',
+                                                   False)}
+
+    mirror_args = dict(config=config, objectstore=store,
+                       name_prefix=charm_conf['name_prefix'])
+    mirror_args['custom_properties'] = charm_conf.get('custom_properties',
+                                                      False)
+    mirror_args['max_parallel_items'] = mirror_info.get(
+        'max_parallel_items', charm_conf.get('max_parallel_items', 1))
+    mirror_args['mirror_url'] = mirror_url
+    mirror_args['resumable_downloads'] = charm_conf.get(
+        'resumable_downloads', False)
+    mirror_args['blob_cache'] = blob_cache
+    rate_limiters = [bandwidth_limiter] if bandwidth_limiter else []
+    if mirror_info.get('bandwidth_limit'):
+        rate_limiters.append(TokenBucket(
+            bandwidth_rate(float(mirror_info['bandwidth_limit']))))
+    mirror_args['rate_limiters'] = rate_limiters
+    mirror_args['image_index'] = image_index
+    mirror_args['products_ledger'] = products_ledger
+    mirror_args['max_parallel_deletes'] = charm_conf.get(
+        'max_parallel_deletes', 1)
+    mirror_args['item_journal'] = item_journal
+    mirror_args['priority_rules'] = parse_priority_rules(
+        mirror_info.get('sync_priority', charm_conf.get('sync_priority')))
+    mirror_args['streaming_upload'] = charm_conf.get('streaming_upload',
+                                                     False)
+    mirror_args['image_import_method'] = charm_conf.get(
+        'image_import_method')
+    mirror_args['disk_format'] = mirror_info.get(
+        'disk_format', charm_conf.get('disk_format'))
+    mirror_args['image_converter'] = image_converter
+    # Only what is read from upstream, not blob cache hits, replays of
+    # partial downloads or images glance imports itself, tells the
+    # throughput of the mirror.
+    download_meter = DownloadMeter()
+    mirror_args['download_meter'] = download_meter
+    if keystone_session is not None:
+        mirror_args['client'] = keystone_session
+
+    regions = sync_regions(charm_conf)
+    # The images of each region get the content_id of the template for
+    # that region, see the target_regions option.
+    region_configs = dict(
+        (region, dict(config, content_id=charm_conf[
+            'content_id_template'].format(region=region)))
+        for region in regions)
+    plans = {}
+    if SIMPLESTREAMS_HAS_PROGRESS:
+        planners = {}
+        for region in regions:
+            log.info("Calling DryRun mirror to plan the sync in "
+                     "{}".format(region))
+            planner = SyncPlanner(config=region_configs[region],
+                                  objectstore=store,
+                                  region=region,
+                                  client=mirror_args.get('client'),
+                                  image_index=image_index)
+            planner.sync(smirror, path=initial_path)
+            planners[region] = planner
+            plan = plans[region] = planner.plan
+            log.info("sync plan for {} in {}: {} items to add ({} bytes), "
+                     "{} to remove".format(mirror_info['url'], region,
+                                           len(plan.additions),
+                                           plan.total_bytes,
+                                           len(plan.removals)))
+        if charm_conf.get('preflight_checks', True):
+            preflight_check(
+                mirror_info['url'], charm_conf,
+                int(mirror_args['max_parallel_items'] or 1), plans,
+                planners, throughput_history)
+        # Progress is reported for the first region only.
+        p = StatusMessageProgressAggregator(dict(plans[regions[0]].items),
+                                            status_exchange.send_message)
+        mirror_args['progress_callback'] = p.progress_callback
+    else:
+        log.info("Detected simplestreams version without progress"
+                 " update support. Only limited feedback available.")
+
+    transfer_hub = None
+    if len(regions) > 1:
+        # Items needed by several regions are downloaded once and teed
+        # into each region's glance.
+        transfer_hub = TransferHub(collections.Counter(
+            (cid, pedigree) for plan in plans.values()
+            for cid, pedigree, _ in plan.additions))
+
+    tmirrors = []
+    published = set()
+    for region in regions:
+        region_config = region_configs[region]
+        region_args = dict(mirror_args, region=region, config=region_config,
+                           plan=plans.get(region),
+                           transfer_hub=transfer_hub)
+        if region_config['content_id'] in published:
+            # The products file of a content_id describes the images of
+            # a single region, it is published from the first of them.
+            log.info("not publishing product streams of {} in {}, they "
+                     "are published for {}".format(
+                         region_config['content_id'], region, regions[0]))
+            region_args['objectstore'] = None
+        published.add(region_config['content_id'])
+        if tmirrors:
+            region_args.pop('progress_callback', None)
+        tmirrors.append(GlanceMirrorWithCustomProperties(**region_args))
+
+    log.info("calling GlanceMirror.sync")
+    if len(tmirrors) == 1:
+        tmirrors[0].sync(smirror, path=initial_path)
+    else:
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=len(tmirrors)) as pool:
+                jobs = [pool.submit(tmirror.sync, smirror, initial_path)
+                        for tmirror in tmirrors]
+            for job in jobs:
+                job.result()
+        finally:
+            transfer_hub.close()
+
+    if throughput_history is not None:
+        log.info("downloaded {} bytes from {} in {:.0f} seconds".format(
+            download_meter.nbytes, mirror_info['url'],
+            download_meter.seconds))
+        throughput_history.record(download_meter.nbytes,
+                                  download_meter.seconds)
+
+
+def sync_regions(charm_conf):
+    """Return the regions to upload images to, the charm's region first."""
+    regions = charm_conf.get('target_regions') or ''
+    regions = regions.replace(',', ' ').split()
+    if not regions:
+        return [charm_conf['region']]
+    if charm_conf['region'] in regions:
+        regions.remove(charm_conf['region'])
+        regions.insert(0, charm_conf['region'])
+    return regions
+
+
+def do_sync(charm_conf, status_exchange, keystone_session=None):
+
+    mirror_list = charm_conf['mirror_list']
+    if not mirror_list:
+        log.info("mirror_list is empty, nothing to sync.")
+        return
+
+    # All mirrors share the pooled HTTP session, and its keep-alive
+    # connections to the image servers.
+    setup_http_session(
+        pool_size=int(charm_conf.get('http_pool_size', HTTP_POOL_SIZE)),
+        user_agent=charm_conf.get('user_agent'))
+
+    max_workers = min(int(charm_conf.get('max_parallel_mirrors', 1)) or 1,
+                      len(mirror_list))
+    log.info("syncing {} mirror(s), {} at a time".format(len(mirror_list),
+                                                         max_workers))
+
+    metadata_cache = None
+    if charm_conf.get('metadata_cache', True):
+        metadata_cache = MetadataCache(METADATA_CACHE_DIR)
+
+    signature_cache = None
+    if charm_conf.get('signature_cache', True):
+        signature_cache = SignatureCache(SIGNATURE_CACHE_FILE, KEYRING)
+
+    bandwidth_limiter = None
+    bandwidth_windows = parse_bandwidth_schedule(
+        charm_conf.get('bandwidth_schedule'))
+    if charm_conf.get('bandwidth_limit') or bandwidth_windows:
+        bandwidth_limiter = TokenBucket(bandwidth_rate(
+            float(charm_conf.get('bandwidth_limit') or 0),
+            bandwidth_windows))
+
+    # The daemon calls do_sync() once per sync, everything opened here is
+    # closed again before it returns.
+    image_index = None
+    item_journal = None
+    image_converter = None
+    try:
+        if charm_conf.get('image_index_max_age', 0):
+            image_index = SyncedImageIndex(
+                IMAGE_INDEX_FILE,
+                int(charm_conf['image_index_max_age']) * 3600)
+
+        if (charm_conf.get('item_journal', True) and
+                keystone_session is not None):
+            item_journal = ItemJournal(ITEM_JOURNAL_FILE)
+            recover_interrupted_items(item_journal, keystone_session,
+                                      image_index=image_index)
+
+        throughput_history = ThroughputHistory(THROUGHPUT_HISTORY_FILE)
+
+        blob_cache = None
+        if charm_conf.get('blob_cache_size', 0):
+            blob_cache = BlobCache(
+                BLOB_CACHE_DIR,
+                int(charm_conf['blob_cache_size']) * 1024 ** 2)
+
+        if (charm_conf.get('disk_format') or
+                any(m.get('disk_format') for m in mirror_list)):
+            image_converter = ImageConverter(
+                charm_conf.get('image_convert_workers',
+                               IMAGE_CONVERT_WORKERS))
+
+        # Each mirror gets its own reader, object store and glance mirror,
+        # so a failing mirror is logged and the remaining ones carry on.
+        # They all publish the same content_id, see ProductsLedger.
+        products_ledger = ProductsLedger()
+        failures = []
+        with futures.ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            jobs = {executor.submit(sync_mirror, charm_conf, mirror_info,
+                                    status_exchange,
+                                    metadata_cache=metadata_cache,
+                                    signature_cache=signature_cache,
+                                    blob_cache=blob_cache,
+                                    keystone_session=keystone_session,
+                                    bandwidth_limiter=bandwidth_limiter,
+                                    image_index=image_index,
+                                    item_journal=item_journal,
+                                    throughput_history=throughput_history,
+                                    image_converter=image_converter,
+                                    products_ledger=products_ledger):
+                    mirror_info
+                    for mirror_info in mirror_list}
+            for job in futures.as_completed(jobs):
+                mirror_info = jobs[job]
+                try:
+                    job.result()
+                except Exception as e:
+                    log.exception("Exception syncing mirror {}:".format(
+                        mirror_info['url']))
+                    failures.append((mirror_info, e))
+    finally:
+        if image_converter is not None:
+            image_converter.close()
+        if item_journal is not None:
+            item_journal.close()
+        if image_index is not None:
+            image_index.close()
+
+    if metadata_cache is not None:
+        metadata_cache.log_stats()
+    if blob_cache is not None:
+        blob_cache.log_stats()
+    if signature_cache is not None:
+        try:
+            signature_cache.save()
+        except (IOError, OSError) as e:
+            log.warning("could not save signature cache: {}".format(e))
+
+    if failures:
+        # A missing glance endpoint affects every mirror, let main() keep
+        # handling it as "not ready yet".
+        for _, e in failures:
+            if isinstance(e, keystone_exceptions.EndpointNotFound):
+                raise e
+        if all(isinstance(e, SyncDeferred) for _, e in failures):
+            raise SyncDeferred('; '.join(str(e) for _, e in failures))
+        raise MirrorSyncError(
+            "{} of {} mirrors failed to sync: {}".format(
+                len(failures), len(mirror_list),
+                ', '.join(m['url'] for m, _ in failures)))
+
+
+def update_product_streams_service(keystone_session, services, region):
     """
     Updates URLs of product-streams endpoint to point to swift URLs.
     """
 
     try:
         catalog = {
-            endpoint_type: ksc.service_catalog.url_for(
-                service_type='object-store', endpoint_type=endpoint_type)
-            for endpoint_type in ['publicURL', 'internalURL', 'adminURL']}
+            endpoint_type + 'URL': keystone_session.endpoint(
+                'object-store', interface=endpoint_type, region_name=region)
+            for endpoint_type in ['public', 'internal', 'admin']}
     except keystone_exceptions.EndpointNotFound as e:
         log.warning("could not retrieve swift endpoint, not updating "
                     "product-streams endpoint: {}".format(e))
@@ -375,44 +3342,77 @@ def juju_run_cmd(cmd):
     return subprocess.check_output(_cmd)
 
 
+# Last workload status set by this process, to skip juju-run calls that
+# would not change it.
+_juju_state = {}
+_juju_state_lock = threading.Lock()
+
+
 def status_set(status, message):
+    with _juju_state_lock:
+        if _juju_state.get('status') == (status, message):
+            return
+        _juju_state['status'] = (status, message)
+    # Not under the lock: juju_run_cmd() reads the configuration, and
+    # reports errors in it with status_set().
+    done = False
     try:
         juju_run_cmd(['status-set', status,
                       '"{}"'.format(message)])
+        done = True
     except subprocess.CalledProcessError:
         log.info(message)
+    finally:
+        if not done:
+            with _juju_state_lock:
+                if _juju_state.get('status') == (status, message):
+                    del _juju_state['status']
 
 
 def update_endpoint_urls(region, publicurl, adminurl, internalurl):
     # Notify keystone via the identity service relation about
     # any endpoint changes.
-    for rid in juju_run_cmd(['relation-ids', 'identity-service']).split():
-        log.info("Updating relation data for: {}".format(rid))
-        _cmd = ['relation-set', '-r', rid]
-        relation_data = {
-            'service': 'image-stream',
-            'region': region,
-            'public_url': publicurl,
-            'admin_url': adminurl,
-            'internal_url': internalurl
-        }
-        for k, v in relation_data.iteritems():
-            _cmd.append('{}={}'.format(k, v))
-        juju_run_cmd(_cmd)
+    relation_data = {
+        'service': 'image-stream',
+        'region': region,
+        'public_url': publicurl,
+        'admin_url': adminurl,
+        'internal_url': internalurl
+    }
+    # Set on every run rather than remembered: a keystone relation joined
+    # since the last run needs the data too, and juju ignores settings
+    # that do not change. A single juju-run sets all the fields on every
+    # relation id.
+    settings = ' '.join(
+        '{}={}'.format(k, shlex.quote(v))
+        for k, v in sorted(relation_data.items()))
+    juju_run_cmd(['for rid in $(relation-ids identity-service); do',
+                  'relation-set -r "$rid"', settings, '; done'])
 
 
 class StatusExchange:
     """Wrapper for rabbitmq status exchange connection.
 
-    If no connection exists, this attempts to create a connection
-    before sending each message.
+    Messages are queued and published by a background thread over a
+    single producer, so a slow broker does not hold up the sync. If no
+    connection exists, the thread attempts to create one before
+    publishing each message. When more than STATUS_QUEUE_SIZE messages
+    are waiting, the oldest progress ("Syncing") message is dropped;
+    other messages are never dropped and their publishing is attempted
+    up to STATUS_PUBLISH_ATTEMPTS times.
     """
 
     def __init__(self):
         self.conn = None
         self.exchange = None
-
-        self._setup_connection()
+        self.producer = None
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._publish_queued,
+                                        name='status-exchange')
+        self._thread.daemon = True
+        self._thread.start()
 
     def _setup_connection(self):
         """Returns True if a valid connection exists already, or if one can be
@@ -478,47 +3478,76 @@ class StatusExchange:
         return True
 
     def send_message(self, msg):
-        if not self._setup_connection():
-            log.warning("No rabbitmq connection available for msg"
-                        "{}. Message will be lost.".format(str(msg)))
-            return
-
-        with self.conn.Producer(exchange=self.exchange) as producer:
-            producer.publish(msg)
+        with self._cond:
+            if len(self._queue) >= STATUS_QUEUE_SIZE:
+                for queued in self._queue:
+                    if queued.get('status') == 'Syncing':
+                        self._queue.remove(queued)
+                        break
+            self._queue.append(msg)
+            self._cond.notify()
+
+    def _publish_queued(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                msg = self._queue.popleft()
+            attempts = 1
+            if msg.get('status') != 'Syncing':
+                attempts = STATUS_PUBLISH_ATTEMPTS
+            self._publish(msg, attempts)
+
+    def _publish(self, msg, attempts):
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(STATUS_PUBLISH_RETRY_DELAY)
+            if not self._setup_connection():
+                self._reset_connection()
+                continue
+            try:
+                if self.producer is None:
+                    self.producer = kombu.Producer(self.conn.channel(),
+                                                   exchange=self.exchange)
+                self.producer.publish(msg)
+                return
+            except Exception:
+                log.exception("Exception publishing status message")
+                self._reset_connection()
+        log.warning("No rabbitmq connection available for msg"
+                    "{}. Message will be lost.".format(str(msg)))
+
+    def _reset_connection(self):
+        try:
+            if self.conn:
+                self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+        self.producer = None
 
     def close(self):
+        """Publish the queued messages, then close the connection."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(STATUS_FLUSH_TIMEOUT)
+        if self._thread.is_alive():
+            log.warning("status messages still queued after {} seconds, "
+                        "not waiting for them".format(STATUS_FLUSH_TIMEOUT))
+            return
         if self.conn:
             self.conn.close()
 
 
-def cleanup():
-    try:
-        os.unlink(SYNC_RUNNING_FLAG_FILE_NAME)
-    except OSError as e:
-        if e.errno != 2:
-            raise e
-
-
-def main():
+def run_sync(keystone_session, ksc, charm_conf):
+    """Sync images once if keystone lists the services needed for it.
 
-    log.info("glance-simplestreams-sync started.")
-
-    lockfile = open(SYNC_RUNNING_FLAG_FILE_NAME, 'w')
-
-    try:
-        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError:
-        log.info("{} is locked, exiting".format(SYNC_RUNNING_FLAG_FILE_NAME))
-        sys.exit(0)
-
-    atexit.register(cleanup)
-    lockfile.write(str(os.getpid()))
-
-    id_conf, charm_conf = get_conf()
-
-    set_openstack_env(id_conf, charm_conf)
-
-    ksc = get_keystone_client(id_conf['api_version'])
+    Returns True when the sync completed, False when the cloud is not
+    ready yet or the sync failed.
+    """
     services = [s._info for s in ksc.services.list()]
     servicenames = [s['name'] for s in services]
     ps_service_exists = PRODUCT_STREAMS_SERVICE_NAME in servicenames
@@ -529,16 +3558,18 @@ def main():
                                         charm_conf['use_swift'],
                                         swift_exists))
 
+    status_exchange = None
     try:
         if not swift_exists and charm_conf['use_swift']:
             # If use_swift is set, we need to wait for swift to become
             # available.
             log.info("Swift not yet ready.")
-            return
+            return False
 
         if ps_service_exists and charm_conf['use_swift'] and swift_exists:
             log.info("Updating product streams service.")
-            update_product_streams_service(ksc, services, charm_conf['region'])
+            update_product_streams_service(keystone_session, services,
+                                           charm_conf['region'])
         else:
             log.info("Not updating product streams service.")
 
@@ -549,7 +3580,8 @@ def main():
 
         status_exchange.send_message({"status": "Started",
                                       "message": "Sync starting."})
-        do_sync(charm_conf, status_exchange)
+        do_sync(charm_conf, status_exchange,
+                keystone_session=keystone_session)
         ts = time.strftime("%x %X")
         # "Unit is ready" is one of approved message prefixes
         # Prefix the message with it will help zaza to understand the status.
@@ -558,28 +3590,148 @@ def main():
                                       "message": completed_msg})
         status_set('active', completed_msg)
 
-        status_exchange.close()
-
         # If this is an initial per-minute sync attempt, delete it on success.
         if os.path.exists(CRON_POLL_FILENAME):
             os.unlink(CRON_POLL_FILENAME)
             log.info(
                 "Initial sync attempt done: every-minute cronjob removed.")
+        return True
 
     except keystone_exceptions.EndpointNotFound as e:
         # matching string "{PublicURL} endpoint for {type}{region} not
         # found".  where {type} is 'image' and {region} is potentially
         # not empty so we only match on this substring:
-        if 'endpoint for image' in e.message:
+        if 'endpoint for image' in str(e):
             log.info("Glance endpoint not found, will continue polling.")
+    except SyncDeferred as e:
+        log.warning(str(e))
+        status_exchange.send_message({"status": "Error", "message": str(e)})
+        status_set('blocked', str(e))
     except Exception as e:
         log.exception("Exception during syncing:")
-        status_exchange.send_message(
-            {"status": "Error", "message": traceback.format_exc()})
+        if status_exchange is not None:
+            status_exchange.send_message(
+                {"status": "Error", "message": traceback.format_exc()})
         status_set('blocked', 'Image sync failed, retrying soon.')
+    finally:
+        if status_exchange is not None:
+            status_exchange.close()
+    return False
+
+
+def save_auth_state(keystone_session):
+    try:
+        keystone_session.save_state()
+    except (IOError, OSError) as e:
+        log.warning("could not save keystone token: {}".format(e))
+
+
+def run_daemon(stop):
+    """Keep syncing on the configured frequency until stop is set.
+
+    Until a sync succeeds, keystone is polled for swift and glance with
+    an exponential backoff instead of the every-minute cron job. The
+    keystone session is reused between runs as long as identity.yaml does
+    not change.
+    """
+    keystone_session = None
+    ksc = None
+    ksc_conf = None
+    backoff = READINESS_BACKOFF_MIN
+    while not stop.is_set():
+        synced = False
+        frequency = None
+        try:
+            id_conf, charm_conf = get_conf()
+        except SystemExit:
+            # get_conf() exits while the charm has not written a complete
+            # configuration yet, keep polling for it.
+            pass
+        else:
+            frequency = charm_conf.get('frequency')
+            try:
+                if ksc is None or ksc_conf != (id_conf, charm_conf['region']):
+                    set_openstack_env(id_conf, charm_conf)
+                    keystone_session = KeystoneSession(id_conf['api_version'])
+                    ksc = get_keystone_client(id_conf['api_version'],
+                                              keystone_session)
+                    ksc_conf = (id_conf, charm_conf['region'])
+                synced = run_sync(keystone_session, ksc, charm_conf)
+                save_auth_state(keystone_session)
+            except Exception:
+                log.exception("Exception while polling keystone:")
+                ksc = None
+
+        if synced:
+            backoff = READINESS_BACKOFF_MIN
+            delay = SYNC_INTERVALS.get(frequency, SYNC_INTERVALS['daily'])
+        else:
+            delay = backoff
+            backoff = min(backoff * 2, READINESS_BACKOFF_MAX)
+        log.info("next sync attempt in {} seconds".format(delay))
+        wait_for_next_sync(stop, delay)
+
+    log.info("glance-simplestreams-sync daemon stopped.")
+
+
+def read_conf_files():
+    """Return the content of the configuration files, None when missing."""
+    contents = []
+    for conf_file_name in [ID_CONF_FILE_NAME, CHARM_CONF_FILE_NAME]:
+        try:
+            with open(conf_file_name, 'rb') as f:
+                contents.append(f.read())
+        except (IOError, OSError):
+            contents.append(None)
+    return contents
+
+
+def wait_for_next_sync(stop, delay):
+    """Wait delay seconds, until stop is set or the configuration changes.
+
+    The charm does not restart the daemon on config-changed, a new
+    frequency or mirror_list applies without waiting out the old delay.
+    """
+    conf = read_conf_files()
+    deadline = time.time() + delay
+    while not stop.is_set():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        stop.wait(min(remaining, CONF_POLL_INTERVAL))
+        if read_conf_files() != conf:
+            log.info("configuration changed, syncing now")
+            return
+
+
+def main(args):
+    startup_mark('imports')
+
+    if args.daemon:
+        stop = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stop.set())
+        if args.print_startup_profile:
+            print_startup_profile()
+        run_daemon(stop)
+        return
+
+    id_conf, charm_conf = get_conf()
+    startup_mark('config')
+
+    set_openstack_env(id_conf, charm_conf)
+
+    keystone_session = KeystoneSession(id_conf['api_version'])
+    ksc = get_keystone_client(id_conf['api_version'], keystone_session)
+    startup_mark('keystone')
+    if args.print_startup_profile:
+        print_startup_profile()
+
+    run_sync(keystone_session, ksc, charm_conf)
+    save_auth_state(keystone_session)
 
     log.info("sync done.")
 
 
 if __name__ == "__main__":
-    main()
+    main(ARGS)
@@ -6,4 +6,4 @@ elif [ -f /etc/juju-proxy.conf ]; then
 elif [ -f /home/ubuntu/.juju-proxy ]; then
     source /home/ubuntu/.juju-proxy
 fi
-exec /usr/share/glance-simplestreams-sync/glance-simplestreams-sync.py
+exec /usr/share/glance-simplestreams-sync/glance-simplestreams-sync.py "$@"
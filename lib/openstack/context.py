@@ -91,7 +91,30 @@ class MirrorsConfigServiceContext(OSContextGenerator):
                         cloud_name=config['cloud_name'],
                         user_agent=config['user_agent'],
                         custom_properties=config['custom_properties'],
-                        hypervisor_mapping=config['hypervisor_mapping'])
+                        hypervisor_mapping=config['hypervisor_mapping'],
+                        max_parallel_mirrors=config['max_parallel_mirrors'],
+                        max_parallel_items=config['max_parallel_items'],
+                        metadata_cache=config['metadata_cache'],
+                        signature_cache=config['signature_cache'],
+                        resumable_downloads=config['resumable_downloads'],
+                        blob_cache_size=config['blob_cache_size'],
+                        target_regions=config['target_regions'],
+                        streaming_upload=config['streaming_upload'],
+                        swift_segment_size=config['swift_segment_size'],
+                        swift_segment_workers=config['swift_segment_workers'],
+                        image_import_method=config['image_import_method'],
+                        frequency=config['frequency'],
+                        http_pool_size=config['http_pool_size'],
+                        bandwidth_limit=config['bandwidth_limit'],
+                        bandwidth_schedule=config['bandwidth_schedule'],
+                        sync_priority=config['sync_priority'],
+                        image_index_max_age=config['image_index_max_age'],
+                        max_parallel_deletes=config['max_parallel_deletes'],
+                        item_journal=config['item_journal'],
+                        preflight_checks=config['preflight_checks'],
+                        max_sync_duration=config['max_sync_duration'],
+                        disk_format=config['disk_format'],
+                        image_convert_workers=config['image_convert_workers'])
 
 
 class IdentityServiceContext(OSContextGenerator):
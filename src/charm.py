@@ -46,9 +46,11 @@ from openstack.context import (
 )
 from openstack.templating import OSConfigRenderer
 
+import filecmp
 import glob
 import os
 import shutil
+import subprocess
 import sys
 
 CONF_FILE_DIR = '/etc/glance-simplestreams-sync'
@@ -65,6 +67,9 @@ CRON_JOB_FILENAME = 'glance_simplestreams_sync'
 CRON_POLL_FILENAME = 'glance_simplestreams_sync_fastpoll'
 CRON_POLL_FILEPATH = os.path.join(CRON_D, CRON_POLL_FILENAME)
 
+SERVICE_NAME = 'glance-simplestreams-sync.service'
+SERVICE_FILEPATH = os.path.join('/etc/systemd/system', SERVICE_NAME)
+
 ERR_FILE_EXISTS = 17
 
 
@@ -74,9 +79,10 @@ class GlanceSimplestreamsSyncCharm(CharmBase):
     _stored = StoredState()
 
     PACKAGES = ['python3-simplestreams', 'python3-glanceclient',
-                'python3-yaml', 'python3-keystoneclient',
-                'python3-kombu',
-                'python3-swiftclient', 'ubuntu-cloudimage-keyring']
+                'python3-yaml', 'python3-keystoneauth1',
+                'python3-keystoneclient', 'python3-kombu', 'python3-requests',
+                'python3-swiftclient', 'qemu-utils',
+                'ubuntu-cloudimage-keyring']
 
     def __init__(self, *args):
         """Initialize charm and configure states and events to observe."""
@@ -123,16 +129,23 @@ class GlanceSimplestreamsSyncCharm(CharmBase):
                     logging.info("'frequency' changed, removing cron job")
                     uninstall_cron_script()
 
-                if config['run']:
+                if config['run'] and config['sync_mode'] == 'daemon':
+                    logging.info("installing {}".format(SERVICE_FILEPATH))
+                    self._uninstall_cron_script()
+                    self._uninstall_cron_poll()
+                    self._install_service()
+                elif config['run']:
                     logging.info("installing to cronjob to "
                                 "/etc/cron.{}".format(config['frequency']))
                     logging.info("installing {} for polling".format(CRON_POLL_FILEPATH))
+                    self._uninstall_service()
                     self._install_cron_poll()
                     self._install_cron_script()
                 else:
                     logging.info("'run' set to False, removing cron jobs")
                     self._uninstall_cron_script()
                     self._uninstall_cron_poll()
+                    self._uninstall_service()
 
                 self._stored._configured = True
             else:
@@ -269,5 +282,45 @@ class GlanceSimplestreamsSyncCharm(CharmBase):
         if os.path.exists(CRON_POLL_FILEPATH):
             os.remove(CRON_POLL_FILEPATH)
 
+    def _install_service(self):
+        """Installs and starts the sync daemon systemd service.
+
+        The daemon re-reads its configuration before every sync and starts
+        one as soon as the configuration changes, so it is only restarted,
+        interrupting any sync in progress, when the unit file or the script
+        it runs changed.
+
+        """
+        changed = False
+        for fn in [SYNC_SCRIPT_NAME, SCRIPT_WRAPPER_NAME]:
+            changed |= _copy_if_changed(os.path.join("files", fn),
+                                        os.path.join(USR_SHARE_DIR, fn))
+        if _copy_if_changed(os.path.join("files", SERVICE_NAME),
+                            SERVICE_FILEPATH):
+            changed = True
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        if changed:
+            subprocess.check_call(['systemctl', 'enable', SERVICE_NAME])
+            subprocess.check_call(['systemctl', 'restart', SERVICE_NAME])
+        else:
+            subprocess.check_call(['systemctl', 'enable', '--now',
+                                   SERVICE_NAME])
+
+    def _uninstall_service(self):
+        "Stops and removes the sync daemon systemd service"
+        if os.path.exists(SERVICE_FILEPATH):
+            subprocess.call(['systemctl', 'disable', '--now', SERVICE_NAME])
+            os.remove(SERVICE_FILEPATH)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+
+
+def _copy_if_changed(src, dst):
+    "Copies src to dst unless dst has the same content, returns if it did"
+    if os.path.exists(dst) and filecmp.cmp(src, dst, shallow=False):
+        return False
+    shutil.copy(src, dst)
+    return True
+
+
 if __name__ == '__main__':
     main(GlanceSimplestreamsSyncCharm)
@@ -0,0 +1,1782 @@
+"""Unit tests for files/glance-simplestreams-sync.py.
+
+The script imports simplestreams and the OpenStack clients at module
+level, the ones it builds on are replaced by the minimal stand-ins below,
+modelled on the parts of the libraries the script relies on.
+"""
+
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+import mock
+
+
+SYNC_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           '..', 'files', 'glance-simplestreams-sync.py')
+
+
+class ContentSource(object):
+    url = None
+
+    def read(self, size=-1):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemoryContentSource(ContentSource):
+
+    def __init__(self, url=None, content=b''):
+        self.url = url
+        self.content = content
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.content)
+        data, self.content = self.content[:size], self.content[size:]
+        return data
+
+
+class UrlReader(ContentSource):
+    pass
+
+
+class MirrorReader(object):
+
+    def __init__(self, policy=None):
+        self.policy = policy or (lambda content, path: content)
+
+    def read_json(self, path):
+        raw = self.source(path).read().decode('utf-8')
+        return raw, self.policy(content=raw, path=path)
+
+
+class UrlMirrorReader(MirrorReader):
+
+    def __init__(self, prefix, mirrors=None, policy=None, user_agent=None):
+        super(UrlMirrorReader, self).__init__(policy=policy)
+        self.prefix = prefix
+        self.user_agent = user_agent
+
+    def source(self, path):
+        return MemoryContentSource(url=self.prefix + path)
+
+
+def get_glanceclient(version='1', **kwargs):
+    """Like simplestreams.mirrors.glance.get_glanceclient(), a session
+    takes precedence over the endpoint."""
+    client = mock.MagicMock()
+    if kwargs.get('session'):
+        client.conn_kwargs = {'session': kwargs['session']}
+    else:
+        client.conn_kwargs = dict((k, kwargs.get(k)) for k in
+                                  ('endpoint', 'token', 'insecure', 'cacert'))
+    return client
+
+
+class GlanceMirror(object):
+
+    def __init__(self, config, objectstore=None, region=None,
+                 name_prefix=None, progress_callback=None, client=None):
+        self.config = config
+        self.store = objectstore
+        self.keystone_creds = client.load_keystone_creds()
+        self.name_prefix = name_prefix or ""
+        if region is not None:
+            self.keystone_creds['region_name'] = region
+        self.progress_callback = progress_callback
+        conn_info = client.get_service_conn_info('image',
+                                                 **self.keystone_creds)
+        self.glance_api_version = conn_info['glance_version']
+        self.gclient = get_glanceclient(version=self.glance_api_version,
+                                        **conn_info)
+        self.tenant_id = conn_info['tenant_id']
+        self.region = self.keystone_creds.get('region_name', 'nullregion')
+        self.cloudname = config.get('cloud_name', 'nullcloud')
+        self.auth_url = self.keystone_creds['auth_url']
+        self.modify_hook = config.get('modify_hook')
+
+    def sync(self, reader, path):
+        pass
+
+    def insert_products(self, path, target, content):
+        if not self.store:
+            return
+        self.store.insert_content(
+            'streams/v1/{}.json'.format(target['content_id']),
+            json.dumps(target))
+
+
+class ItemInfoDryRunMirror(GlanceMirror):
+    pass
+
+
+class ProgressAggregator(object):
+
+    def __init__(self, remaining_items=None):
+        self.remaining_items = remaining_items
+        self.total_image_count = len(remaining_items or {})
+        self.total_size = sum((remaining_items or {}).values())
+        self.total_written = 0
+
+
+def products_set(tree, data, pedigree):
+    (product, version, item) = pedigree
+    versions = tree.setdefault('products', {}).setdefault(
+        product, {}).setdefault('versions', {})
+    versions.setdefault(version, {}).setdefault('items', {})[item] = data
+
+
+def products_del(tree, pedigree):
+    (product, version, item) = pedigree
+    versions = tree['products'][product]['versions']
+    del versions[version]['items'][item]
+    if not versions[version]['items']:
+        del versions[version]
+    if not versions:
+        del tree['products'][product]
+
+
+class ObjectStore(object):
+    pass
+
+
+class SwiftObjectStore(ObjectStore):
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        self.swiftclient.put_object(self.container, self.path_prefix + path,
+                                    contents=reader.read())
+
+
+class ClientException(Exception):
+
+    def __init__(self, msg, http_status=None):
+        super(ClientException, self).__init__(msg)
+        self.http_status = http_status
+
+
+def _stub_modules():
+    """Return sys.modules entries standing in for the script's imports."""
+    stubs = {}
+    for name in ('glanceclient', 'keystoneauth1', 'keystoneclient',
+                 'keystoneclient.v2_0',
+                 'keystoneclient.v3', 'kombu', 'requests', 'swiftclient',
+                 'swiftclient.client'):
+        stubs[name] = mock.MagicMock(name=name)
+
+    exceptions = types.ModuleType('keystoneclient.exceptions')
+    exceptions.EndpointNotFound = type('EndpointNotFound', (Exception,), {})
+    stubs['keystoneclient.exceptions'] = exceptions
+    stubs['keystoneclient'].exceptions = exceptions
+    stubs['swiftclient.client'].ClientException = ClientException
+    stubs['swiftclient'].client = stubs['swiftclient.client']
+
+    contentsource = types.ModuleType('simplestreams.contentsource')
+    contentsource.ContentSource = ContentSource
+    contentsource.UrlReader = UrlReader
+    contentsource.MemoryContentSource = MemoryContentSource
+
+    glance = types.ModuleType('simplestreams.mirrors.glance')
+    glance.GlanceMirror = GlanceMirror
+    glance.ItemInfoDryRunMirror = ItemInfoDryRunMirror
+    glance.get_glanceclient = get_glanceclient
+    glance.empty_iid_products = lambda content_id: {
+        'content_id': content_id, 'products': {}}
+
+    mirrors = types.ModuleType('simplestreams.mirrors')
+    mirrors.glance = glance
+    mirrors.UrlMirrorReader = UrlMirrorReader
+
+    swift = types.ModuleType('simplestreams.objectstores.swift')
+    swift.SwiftObjectStore = SwiftObjectStore
+    objectstores = types.ModuleType('simplestreams.objectstores')
+    objectstores.FileStore = type('FileStore', (ObjectStore,), {})
+    objectstores.swift = swift
+
+    util = types.ModuleType('simplestreams.util')
+    for name in ('read_signed', 'path_from_mirror_url', 'products_exdata'):
+        setattr(util, name, mock.MagicMock(name=name))
+    util.products_set = products_set
+    util.products_del = products_del
+    util.ProgressAggregator = ProgressAggregator
+
+    simplestreams = types.ModuleType('simplestreams')
+    simplestreams.contentsource = contentsource
+    simplestreams.mirrors = mirrors
+    simplestreams.objectstores = objectstores
+    simplestreams.util = util
+    stubs.update({'simplestreams': simplestreams,
+                  'simplestreams.contentsource': contentsource,
+                  'simplestreams.mirrors': mirrors,
+                  'simplestreams.mirrors.glance': glance,
+                  'simplestreams.objectstores': objectstores,
+                  'simplestreams.objectstores.swift': swift,
+                  'simplestreams.util': util})
+    return stubs
+
+
+def load_sync_script():
+    spec = importlib.util.spec_from_file_location('glance_simplestreams_sync',
+                                                  SYNC_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # setup_logging() writes to /var/log.
+    with mock.patch.dict(sys.modules, _stub_modules()), \
+            mock.patch('logging.FileHandler',
+                       return_value=logging.NullHandler()), \
+            mock.patch('os.path.exists', return_value=True), \
+            mock.patch('os.chmod'):
+        spec.loader.exec_module(module)
+    return module
+
+
+gss = load_sync_script()
+
+
+OS_ENV = {'OS_AUTH_URL': 'https://keystone.example:5000/v3',
+          'OS_USERNAME': 'admin',
+          'OS_PASSWORD': 'secret',
+          'OS_USER_DOMAIN_NAME': 'service_domain',
+          'OS_PROJECT_DOMAIN_NAME': 'service_domain',
+          'OS_PROJECT_NAME': 'services',
+          'OS_PROJECT_ID': 'p1',
+          'OS_REGION_NAME': 'RegionOne'}
+
+
+class TestKeystoneSession(unittest.TestCase):
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ, OS_ENV)
+        env.start()
+        self.addCleanup(env.stop)
+        self.session = gss.KeystoneSession(3, state_file='/nonexistent')
+        self.session.session.get_endpoint.side_effect = (
+            lambda service_type, interface, region_name:
+            'https://glance.{}:9292'.format(region_name))
+
+    def test_load_keystone_creds(self):
+        creds = self.session.load_keystone_creds()
+        self.assertEqual(creds['auth_url'], OS_ENV['OS_AUTH_URL'])
+        self.assertEqual(creds['region_name'], 'RegionOne')
+        self.assertNotIn('password', creds)
+
+    @mock.patch.object(gss.glanceclient, 'Client')
+    def test_glance_mirror_constructor(self, glance_client):
+        mirror = gss.GlanceMirrorWithCustomProperties(
+            config={'content_id': 'auto.sync'}, objectstore=None,
+            region='RegionTwo', client=self.session)
+        self.assertEqual(mirror.region, 'RegionTwo')
+        self.assertEqual(mirror.auth_url, OS_ENV['OS_AUTH_URL'])
+        # The glance client talks to the glance of the mirror's region,
+        # with the session renewing the token as needed.
+        glance_client.assert_called_once_with(
+            '2', session=self.session.session, region_name='RegionTwo',
+            interface='public')
+        self.assertIs(mirror.gclient, glance_client.return_value)
+        self.assertIsInstance(mirror.gclient.images, gss.GlanceImagesProxy)
+
+    @mock.patch.object(gss.glanceclient, 'Client')
+    def test_sync_planner_constructor(self, glance_client):
+        planner = gss.SyncPlanner(config={'content_id': 'auto.sync'},
+                                  objectstore=None, client=self.session)
+        self.assertEqual(planner.region, 'RegionOne')
+        self.assertEqual(planner.gclient, glance_client.return_value)
+        self.assertEqual(glance_client.call_args[1]['region_name'],
+                         'RegionOne')
+
+
+class MemoryStore(object):
+    """Product-streams store keeping what is written in a dict."""
+
+    def __init__(self):
+        self.files = {}
+
+    def insert_content(self, path, content):
+        self.files[path] = json.loads(content)
+
+
+class TestProductsLedger(unittest.TestCase):
+
+    def mirror(self, ledger, store):
+        mirror = gss.GlanceMirrorWithCustomProperties.__new__(
+            gss.GlanceMirrorWithCustomProperties)
+        mirror.config = {'content_id': 'auto.sync'}
+        mirror.region = 'RegionOne'
+        mirror.store = store
+        mirror.image_index = None
+        mirror.products_ledger = ledger
+        mirror.priority_rules = []
+        mirror._local = threading.local()
+        mirror._deferred_items = []
+        mirror._pending_items = []
+        mirror._pending_removals = []
+        return mirror
+
+    def test_concurrent_mirrors_keep_each_others_items(self):
+        ledger = gss.ProductsLedger()
+        store = MemoryStore()
+        first, second = self.mirror(ledger, store), self.mirror(ledger, store)
+        # Both mirrors loaded the same tree when they started.
+        loaded = {'content_id': 'auto.sync', 'products': {}}
+        products_set(loaded, {'id': 'img0'}, ('focal', 'v1', 'disk1.img'))
+        first_target = json.loads(json.dumps(loaded))
+        second_target = json.loads(json.dumps(loaded))
+
+        products_set(first_target, {'id': 'img1'},
+                     ('jammy', 'v1', 'disk1.img'))
+        first._record_item(('jammy', 'v1', 'disk1.img'), {'id': 'img1'})
+        first.remove_item({}, {}, first_target, ('focal', 'v1', 'disk1.img'))
+        first.insert_products('streams/v1/auto.sync.json', first_target, None)
+
+        products_set(second_target, {'id': 'img2'},
+                     ('noble', 'v1', 'disk1.img'))
+        second._record_item(('noble', 'v1', 'disk1.img'), {'id': 'img2'})
+        second.insert_products('streams/v1/auto.sync.json', second_target,
+                               None)
+
+        published = store.files['streams/v1/auto.sync.json']
+        self.assertEqual(sorted(published['products']), ['jammy', 'noble'])
+
+    def test_other_regions_are_not_merged(self):
+        ledger = gss.ProductsLedger()
+        ledger.add('auto.sync', 'RegionTwo', ('jammy', 'v1', 'disk1.img'),
+                   {'id': 'img1'})
+        tree = {'content_id': 'auto.sync', 'products': {}}
+        ledger.merge('auto.sync', 'RegionOne', tree)
+        self.assertEqual(tree['products'], {})
+
+
+class TestDoSync(unittest.TestCase):
+
+    CHARM_CONF = {'mirror_list': [{'url': 'http://a/'}, {'url': 'http://b/'}],
+                  'max_parallel_mirrors': 2,
+                  'metadata_cache': False,
+                  'signature_cache': False}
+
+    def setUp(self):
+        history = mock.patch.object(gss, 'ThroughputHistory')
+        self.history = history.start()
+        self.addCleanup(history.stop)
+
+    @mock.patch.object(gss, 'sync_mirror')
+    def test_failing_mirror_does_not_stop_the_others(self, sync_mirror):
+        synced = []
+
+        def sync(charm_conf, mirror_info, status_exchange, **kwargs):
+            if mirror_info['url'] == 'http://a/':
+                raise IOError('unreachable')
+            synced.append(mirror_info['url'])
+
+        sync_mirror.side_effect = sync
+        with self.assertRaises(gss.MirrorSyncError) as cm:
+            gss.do_sync(self.CHARM_CONF, mock.MagicMock())
+        self.assertIn('1 of 2 mirrors failed to sync: http://a/',
+                      str(cm.exception))
+        self.assertEqual(synced, ['http://b/'])
+        # The mirrors of a run share one products ledger.
+        ledgers = set(id(call[1]['products_ledger'])
+                      for call in sync_mirror.call_args_list)
+        self.assertEqual(len(ledgers), 1)
+
+    @mock.patch.object(gss, 'sync_mirror')
+    def test_deferred_mirrors(self, sync_mirror):
+        sync_mirror.side_effect = gss.SyncDeferred('not enough disk')
+        self.assertRaises(gss.SyncDeferred, gss.do_sync, self.CHARM_CONF,
+                          mock.MagicMock())
+
+    @mock.patch.object(gss, 'SyncedImageIndex')
+    @mock.patch.object(gss, 'sync_mirror')
+    def test_image_index_is_closed(self, sync_mirror, image_index):
+        charm_conf = dict(self.CHARM_CONF, image_index_max_age=24)
+        gss.do_sync(charm_conf, mock.MagicMock())
+        self.assertIs(sync_mirror.call_args[1]['image_index'],
+                      image_index.return_value)
+        image_index.return_value.close.assert_called_once_with()
+
+        image_index.reset_mock()
+        self.history.side_effect = IOError('read-only file system')
+        self.assertRaises(IOError, gss.do_sync, charm_conf, mock.MagicMock())
+        image_index.return_value.close.assert_called_once_with()
+
+    @mock.patch.object(gss, 'recover_interrupted_items')
+    @mock.patch.object(gss, 'ItemJournal')
+    @mock.patch.object(gss, 'sync_mirror')
+    def test_item_journal_is_closed(self, sync_mirror, item_journal,
+                                    recover):
+        sync_mirror.side_effect = IOError('unreachable')
+        self.assertRaises(gss.MirrorSyncError, gss.do_sync, self.CHARM_CONF,
+                          mock.MagicMock(), keystone_session=mock.MagicMock())
+        recover.assert_called_once_with(
+            item_journal.return_value, mock.ANY, image_index=None)
+        self.assertIs(sync_mirror.call_args[1]['item_journal'],
+                      item_journal.return_value)
+        item_journal.return_value.close.assert_called_once_with()
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    URL = 'http://mirror/streams/v1/index.sjson'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = gss.MetadataCache(os.path.join(self.tmpdir, 'cache'))
+        self.session = mock.MagicMock()
+        http_session = mock.patch.object(gss, 'http_session',
+                                         return_value=self.session)
+        http_session.start()
+        self.addCleanup(http_session.stop)
+
+    def response(self, status_code=200, content=b'', headers=None):
+        response = mock.MagicMock(status_code=status_code, content=content)
+        response.headers = headers or {}
+        return response
+
+    def test_unchanged_file_is_read_from_disk(self):
+        self.session.get.return_value = self.response(
+            content=b'index', headers={'ETag': '"v1"',
+                                       'Last-Modified': 'yesterday'})
+        self.assertEqual(self.cache.fetch(self.URL), b'index')
+
+        self.session.get.return_value = self.response(status_code=304)
+        self.assertEqual(self.cache.fetch(self.URL), b'index')
+        self.assertEqual(self.session.get.call_args[1]['headers'],
+                         {'If-None-Match': '"v1"',
+                          'If-Modified-Since': 'yesterday'})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changed_file_replaces_the_cached_one(self):
+        self.session.get.return_value = self.response(
+            content=b'index', headers={'ETag': '"v1"'})
+        self.cache.fetch(self.URL)
+        self.session.get.return_value = self.response(
+            content=b'new index', headers={'ETag': '"v2"'})
+        self.assertEqual(self.cache.fetch(self.URL), b'new index')
+
+        self.session.get.return_value = self.response(status_code=304)
+        self.assertEqual(self.cache.fetch(self.URL), b'new index')
+        self.assertEqual(self.session.get.call_args[1]['headers'],
+                         {'If-None-Match': '"v2"'})
+
+    def test_file_without_validators_is_not_cached(self):
+        self.session.get.return_value = self.response(content=b'index')
+        self.cache.fetch(self.URL)
+        self.cache.fetch(self.URL)
+        self.assertEqual(self.session.get.call_args[1]['headers'], {})
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'cache')), [])
+
+    def test_error_is_raised(self):
+        response = self.response(status_code=500)
+        response.raise_for_status.side_effect = IOError('500')
+        self.session.get.return_value = response
+        self.assertRaises(IOError, self.cache.fetch, self.URL)
+
+
+class TestConditionalUrlMirrorReader(unittest.TestCase):
+
+    def test_read_json_returns_raw_then_payload(self):
+        cache = mock.MagicMock()
+        cache.fetch.return_value = b'signed'
+        policy = mock.MagicMock(return_value='payload')
+        reader = gss.ConditionalUrlMirrorReader('http://mirror/', cache,
+                                                policy=policy)
+        self.assertEqual(reader.read_json('streams/v1/index.sjson'),
+                         ('signed', 'payload'))
+        cache.fetch.assert_called_once_with(
+            'http://mirror/streams/v1/index.sjson')
+        policy.assert_called_once_with(content='signed',
+                                       path='streams/v1/index.sjson')
+
+    def test_read_json_falls_back_to_direct_read(self):
+        cache = mock.MagicMock()
+        cache.fetch.side_effect = IOError('unreachable')
+        reader = gss.ConditionalUrlMirrorReader(
+            'http://mirror/', cache, policy=lambda content, path: 'payload')
+        with mock.patch.object(UrlMirrorReader, 'source',
+                               return_value=MemoryContentSource(
+                                   content=b'signed')):
+            self.assertEqual(reader.read_json('streams/v1/index.sjson'),
+                             ('signed', 'payload'))
+
+
+class TestSignatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'signature-cache.json')
+        self.keyring = os.path.join(self.tmpdir, 'keyring.gpg')
+        with open(self.keyring, 'wb') as f:
+            f.write(b'key')
+        read_signed = mock.patch.object(gss, 'read_signed',
+                                        return_value='payload')
+        self.read_signed = read_signed.start()
+        self.addCleanup(read_signed.stop)
+
+    def test_verified_content_is_not_verified_again(self):
+        cache = gss.SignatureCache(self.path, self.keyring)
+        self.assertEqual(cache.read_signed('signed'), 'payload')
+        self.read_signed.assert_called_with('signed', keyring=self.keyring)
+        cache.save()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+        cache = gss.SignatureCache(self.path, self.keyring)
+        self.assertEqual(cache.read_signed('signed'), 'payload')
+        self.read_signed.assert_called_with('signed', keyring=self.keyring,
+                                            checked=False)
+        cache.read_signed('other')
+        self.read_signed.assert_called_with('other', keyring=self.keyring)
+
+    def test_keyring_change_discards_the_cache(self):
+        cache = gss.SignatureCache(self.path, self.keyring)
+        cache.read_signed('signed')
+        cache.save()
+        with open(self.keyring, 'wb') as f:
+            f.write(b'new key')
+
+        cache = gss.SignatureCache(self.path, self.keyring)
+        self.assertEqual(cache.digests, {})
+        cache.read_signed('signed')
+        self.read_signed.assert_called_with('signed', keyring=self.keyring)
+
+    def test_failed_verification_is_not_cached(self):
+        self.read_signed.side_effect = ValueError('bad signature')
+        cache = gss.SignatureCache(self.path, self.keyring)
+        self.assertRaises(ValueError, cache.read_signed, 'signed')
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_cache_size_is_bounded(self):
+        cache = gss.SignatureCache(self.path, self.keyring)
+        with mock.patch.object(gss, 'SIGNATURE_CACHE_MAX_ENTRIES', 2):
+            for content in ('a', 'b', 'c'):
+                cache.read_signed(content)
+            cache.save()
+        self.assertEqual(
+            len(gss.SignatureCache(self.path, self.keyring).digests), 2)
+
+
+class FakeRaw(object):
+    """urllib3 response body answering reads in chunks of at most
+    max_read bytes, like a network connection."""
+
+    def __init__(self, content, max_read=64 * 1024):
+        self.content = content
+        self.max_read = max_read
+
+    def read(self, size, decode_content=False):
+        size = min(size, self.max_read)
+        data, self.content = self.content[:size], self.content[size:]
+        return data
+
+
+def get_local_copy(source, read_size=1024 * 1024):
+    """The read loop of simplestreams.util.get_local_copy()."""
+    data = []
+    while True:
+        buf = source.read(read_size)
+        data.append(buf)
+        if len(buf) != read_size:
+            return b''.join(data)
+
+
+class TestResumableContentSource(unittest.TestCase):
+
+    URL = 'http://mirror/disk1.img'
+    CONTENT = bytes(bytearray(range(256))) * (3 * 4096) + b'tail'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.session = mock.MagicMock()
+        http_session = mock.patch.object(gss, 'http_session',
+                                         return_value=self.session)
+        http_session.start()
+        self.addCleanup(http_session.stop)
+        self.responses = []
+        self.session.get.side_effect = self.get
+
+    def get(self, url, headers=None, **kwargs):
+        offset = 0
+        if headers and 'Range' in headers:
+            offset = int(headers['Range'][len('bytes='):-1])
+        response = mock.MagicMock(status_code=206 if offset else 200)
+        response.headers = {'ETag': '"v1"'}
+        response.raw = FakeRaw(self.CONTENT[offset:])
+        self.responses.append(response)
+        return response
+
+    def source(self):
+        return gss.ResumableContentSource(
+            self.URL, self.tmpdir, size=len(self.CONTENT),
+            checksums={'sha256': hashlib.sha256(self.CONTENT).hexdigest()})
+
+    def interrupt_at(self, offset):
+        """Leave the partial file and journal of a download killed after
+        offset bytes."""
+        source = self.source()
+        source.open()
+        source.out.write(self.CONTENT[:offset])
+        source.hashers['sha256'].update(self.CONTENT[:offset])
+        source.offset = offset
+        source.close()
+        self.responses = []
+        return source
+
+    def test_download(self):
+        source = self.source()
+        self.assertEqual(get_local_copy(source), self.CONTENT)
+        source.close()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_resume_at_unaligned_offset(self):
+        partial = self.interrupt_at(1024 * 1024 + 100)
+        with open(partial.journal_path) as f:
+            self.assertEqual(json.load(f)['offset'], 1024 * 1024 + 100)
+
+        source = self.source()
+        self.assertEqual(get_local_copy(source), self.CONTENT)
+        self.assertEqual(self.responses[0].status_code, 206)
+        self.assertTrue(source.complete)
+        source.close()
+        # The verified download leaves nothing behind for the next run.
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_resume_of_a_changed_file_restarts(self):
+        self.interrupt_at(1000)
+        with open(self.source().partial_path, 'r+b') as f:
+            f.write(b'corrupt')
+        source = self.source()
+        self.assertEqual(get_local_copy(source), self.CONTENT)
+        self.assertNotIn('Range', self.session.get.call_args[1]['headers'])
+        source.close()
+
+    def test_checksum_mismatch_discards_the_partial_file(self):
+        source = gss.ResumableContentSource(
+            self.URL, self.tmpdir, size=len(self.CONTENT),
+            checksums={'sha256': 'bad'})
+        self.assertRaises(gss.ChecksumMismatchError, get_local_copy, source)
+        source.close()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class TestBlobCache(unittest.TestCase):
+
+    CONTENT = b'x' * (1024 * 1024) + b'tail'
+    SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = gss.BlobCache(self.tmpdir, max_size=10)
+
+    def add(self, sha256, content, mtime):
+        tmp_path, tmp = self.cache.create_temp(sha256)
+        with tmp:
+            tmp.write(content)
+        self.cache.commit(tmp_path, sha256)
+        os.utime(os.path.join(self.tmpdir, sha256), (mtime, mtime))
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        self.add('a', b'aaaa', 100)
+        self.add('b', b'bbbb', 200)
+        # Looked up, a is now the most recently used.
+        self.assertEqual(self.cache.lookup('a'),
+                         os.path.join(self.tmpdir, 'a'))
+        self.add('c', b'cccc', 300)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['a', 'c'])
+        self.assertIsNone(self.cache.lookup('b'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_download_fills_the_cache(self):
+        self.cache.max_size = 10 * 1024 * 1024
+        source = gss.BlobCacheFillingContentSource(
+            MemoryContentSource(content=self.CONTENT), self.cache,
+            self.SHA256)
+        self.assertEqual(get_local_copy(source), self.CONTENT)
+        source.close()
+        path = self.cache.lookup(self.SHA256)
+
+        cached = gss.CachedBlobContentSource(self.cache, path, self.SHA256)
+        self.assertEqual(get_local_copy(cached), self.CONTENT)
+        cached.close()
+
+    def test_mismatching_download_is_not_cached(self):
+        source = gss.BlobCacheFillingContentSource(
+            MemoryContentSource(content=b'other'), self.cache, self.SHA256)
+        get_local_copy(source)
+        source.close()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_interrupted_download_is_not_cached(self):
+        source = gss.BlobCacheFillingContentSource(
+            MemoryContentSource(content=self.CONTENT), self.cache,
+            self.SHA256)
+        source.read(1024)
+        source.close()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_corrupt_blob_is_removed(self):
+        self.add(self.SHA256, b'corrupt', 100)
+        path = self.cache.lookup(self.SHA256)
+        cached = gss.CachedBlobContentSource(self.cache, path, self.SHA256)
+        self.assertRaises(gss.ChecksumMismatchError, get_local_copy, cached)
+        cached.close()
+        self.assertIsNone(self.cache.lookup(self.SHA256))
+
+
+class SlowContentSource(MemoryContentSource):
+    """Upstream source answering reads in chunks of at most 64 KiB."""
+
+    def read(self, size=-1):
+        time.sleep(0.001)
+        return super(SlowContentSource, self).read(min(size, 64 * 1024))
+
+
+class TestTeeTransfer(unittest.TestCase):
+
+    CONTENT = b'x' * (3 * 1024 * 1024) + b'tail'
+
+    def consume(self, branch, results):
+        results.append(get_local_copy(branch))
+        branch.close()
+
+    def test_consumers_faster_than_the_pump_get_everything(self):
+        transfer = gss.TeeTransfer(SlowContentSource(content=self.CONTENT),
+                                   consumers=2)
+        results = []
+        threads = [threading.Thread(target=self.consume,
+                                    args=(transfer.branch(), results))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(len(result), len(self.CONTENT))
+        # Removed once every consumer is done.
+        self.assertFalse(os.path.exists(transfer.spool_path))
+
+    def test_upstream_error_is_raised_to_consumers(self):
+        source = SlowContentSource(content=b'x' * 100)
+        source.read = mock.MagicMock(side_effect=IOError('reset'))
+        transfer = gss.TeeTransfer(source, consumers=1)
+        branch = transfer.branch()
+        self.assertRaises(IOError, branch.read, 1024)
+        branch.close()
+
+
+class TestSyncMirrorRegions(unittest.TestCase):
+
+    CHARM_CONF = {'use_swift': False,
+                  'region': 'RegionOne',
+                  'target_regions': 'RegionOne RegionTwo',
+                  'modify_hook_scripts': [],
+                  'cloud_name': 'cloud',
+                  'name_prefix': 'auto-sync/',
+                  'preflight_checks': False}
+
+    def setUp(self):
+        for name, value in (
+                ('path_from_mirror_url', lambda url, path: (url, path)),
+                ('FileStore', mock.MagicMock()),
+                ('SyncPlanner', mock.MagicMock(
+                    side_effect=lambda **kwargs: mock.MagicMock(
+                        plan=gss.SyncPlan()))),
+                ('GlanceMirrorWithCustomProperties', mock.MagicMock())):
+            patcher = mock.patch.object(gss, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sync(self, content_id_template):
+        charm_conf = dict(self.CHARM_CONF,
+                          content_id_template=content_id_template)
+        gss.sync_mirror(charm_conf, {'url': 'http://mirror/',
+                                     'path': 'streams/v1/index.sjson',
+                                     'max': 1, 'item_filters': []},
+                        mock.MagicMock())
+        return dict((kwargs['region'], kwargs) for _, kwargs in
+                    gss.GlanceMirrorWithCustomProperties.call_args_list)
+
+    def test_regions_publish_their_own_content_id(self):
+        mirrors = self.sync('auto.{region}')
+        self.assertEqual(mirrors['RegionTwo']['config']['content_id'],
+                         'auto.RegionTwo')
+        self.assertIsNotNone(mirrors['RegionOne']['objectstore'])
+        self.assertIsNotNone(mirrors['RegionTwo']['objectstore'])
+
+    def test_shared_content_id_is_published_from_the_first_region(self):
+        mirrors = self.sync('auto.sync')
+        self.assertIsNotNone(mirrors['RegionOne']['objectstore'])
+        self.assertIsNone(mirrors['RegionTwo']['objectstore'])
+
+
+class FakeSwift(object):
+    """In-memory swiftclient Connection."""
+
+    def __init__(self):
+        self.objects = {}
+        self.fail_manifest = False
+
+    def put_container(self, container, headers=None):
+        pass
+
+    def put_object(self, container, name, contents=None, query_string=None,
+                   **kwargs):
+        if hasattr(contents, 'read'):
+            contents = contents.read()
+        headers = {}
+        if query_string == 'multipart-manifest=put':
+            if self.fail_manifest:
+                raise ClientException('manifest rejected', http_status=400)
+            headers['x-static-large-object'] = 'True'
+            contents = json.dumps([{'name': segment['path']} for segment
+                                   in json.loads(contents)])
+        self.objects[(container, name)] = (headers, contents)
+
+    def head_object(self, container, name):
+        if (container, name) not in self.objects:
+            raise ClientException('not found', http_status=404)
+        return self.objects[(container, name)][0]
+
+    def get_object(self, container, name, query_string=None):
+        return self.objects[(container, name)]
+
+    def delete_object(self, container, name):
+        if self.objects.pop((container, name), None) is None:
+            raise ClientException('not found', http_status=404)
+
+
+class TestSegmentedSwiftObjectStore(unittest.TestCase):
+
+    def setUp(self):
+        self.swift = FakeSwift()
+        self.store = gss.SegmentedSwiftObjectStore.__new__(
+            gss.SegmentedSwiftObjectStore)
+        self.store.container = 'simplestreams'
+        self.store.path_prefix = 'data/'
+        self.store.swiftclient = self.swift
+        self.store.keystone_session = None
+        self.store.region = None
+        self.store.segment_size = 4
+        self.store.segment_workers = 2
+        self.store.segment_container = 'simplestreams_segments'
+        self.store._connection = lambda: self.swift
+
+    def segments(self):
+        return sorted(name for container, name in self.swift.objects
+                      if container == 'simplestreams_segments')
+
+    def test_small_content_of_unknown_size_is_a_plain_put(self):
+        self.store.insert('index.json', MemoryContentSource(content=b'{}'))
+        self.assertEqual(self.swift.objects,
+                         {('simplestreams', 'data/index.json'): ({}, b'{}')})
+
+    def test_large_content_is_segmented(self):
+        self.store.insert('image', MemoryContentSource(content=b'x' * 10))
+        headers, manifest = self.swift.objects[('simplestreams',
+                                                'data/image')]
+        self.assertEqual(headers['x-static-large-object'], 'True')
+        self.assertEqual(len(json.loads(manifest)), 3)
+        self.assertEqual(len(self.segments()), 3)
+
+    def test_replaced_object_segments_are_deleted(self):
+        self.store.insert('image', MemoryContentSource(content=b'x' * 10))
+        first = self.segments()
+        self.store.insert('image', MemoryContentSource(content=b'y' * 9))
+        self.assertEqual(len(self.segments()), 3)
+        self.assertFalse(set(first) & set(self.segments()))
+
+        self.store.insert('image', MemoryContentSource(content=b'z'))
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.swift.objects[('simplestreams', 'data/image')],
+                         ({}, b'z'))
+
+    def test_known_size_put_deletes_the_replaced_segments(self):
+        self.store.insert('image', MemoryContentSource(content=b'x' * 10))
+        self.store.insert('image', MemoryContentSource(content=b'z'), size=1)
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.swift.objects[('simplestreams', 'data/image')],
+                         ({}, b'z'))
+
+    @mock.patch.object(gss, 'SWIFT_MAX_MANIFEST_SEGMENTS', 2)
+    def test_known_size_uses_larger_segments_over_the_limit(self):
+        self.store.insert('image', MemoryContentSource(content=b'x' * 10),
+                          size=10)
+        headers, manifest = self.swift.objects[('simplestreams',
+                                                'data/image')]
+        self.assertEqual(len(json.loads(manifest)), 2)
+
+    @mock.patch.object(gss, 'SWIFT_MAX_MANIFEST_SEGMENTS', 2)
+    def test_unknown_size_over_the_limit_fails(self):
+        with self.assertRaises(IOError):
+            self.store.insert('image', MemoryContentSource(content=b'x' * 10))
+        self.assertEqual(self.swift.objects, {})
+
+    def test_segments_are_deleted_on_checksum_mismatch(self):
+        with self.assertRaises(gss.ChecksumMismatchError):
+            self.store.insert('image', MemoryContentSource(content=b'x' * 10),
+                              checksums={'md5': 'bad'})
+        self.assertEqual(self.swift.objects, {})
+
+    def test_segments_are_deleted_when_manifest_fails(self):
+        self.swift.fail_manifest = True
+        with self.assertRaises(ClientException):
+            self.store.insert('image', MemoryContentSource(content=b'x' * 10))
+        self.assertEqual(self.swift.objects, {})
+
+
+class TestStatusMessageProgressAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(gss.time, 'time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.messages = []
+        self.aggregator = gss.StatusMessageProgressAggregator(
+            {'a.img': 1000, 'b.img': 1000}, self.messages.append,
+            min_interval=5, min_step=0.1)
+
+    def progress(self, name, written, seconds=0):
+        self.now += seconds
+        self.aggregator.progress_callback(
+            {'name': name, 'size': 1000, 'written': written,
+             'status': 'Downloading'})
+
+    def test_progress_is_coalesced(self):
+        self.progress('a.img', 10)
+        # Too soon.
+        self.progress('a.img', 200, seconds=1)
+        self.assertEqual(len(self.messages), 1)
+        self.progress('a.img', 10, seconds=10)
+        self.assertEqual(len(self.messages), 2)
+        self.assertIn('a.img 22%', self.messages[-1]['message'])
+        # Too small a step.
+        self.progress('a.img', 50, seconds=10)
+        self.assertEqual(len(self.messages), 2)
+        self.progress('a.img', 50, seconds=1)
+        self.assertEqual(len(self.messages), 3)
+        self.assertIn('a.img 32%', self.messages[-1]['message'])
+
+    def test_first_and_last_message_of_each_file_are_sent(self):
+        self.progress('a.img', 10)
+        self.progress('b.img', 10)
+        self.progress('a.img', 990)
+        self.assertEqual(len(self.messages), 3)
+        self.assertIn('a.img 100%', self.messages[-1]['message'])
+        self.assertEqual(self.aggregator.remaining_items, {'b.img': 1000})
+        self.assertEqual(self.messages[-1]['status'], 'Syncing')
+
+
+class TestStatusExchange(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = mock.MagicMock(name='conn')
+        self.published = []
+        self.kombu = mock.patch.object(gss, 'kombu').start()
+        self.producer = self.kombu.Producer.return_value
+        self.producer.publish.side_effect = self.published.append
+        self.sleep = mock.patch.object(gss.time, 'sleep').start()
+
+        def setup_connection(exchange):
+            exchange.conn = self.conn
+            return True
+
+        mock.patch.object(gss.StatusExchange, '_setup_connection',
+                          setup_connection).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_oldest_progress_message_is_dropped_when_full(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def publish(msg):
+            started.set()
+            release.wait(5)
+            self.published.append(msg)
+
+        self.producer.publish.side_effect = publish
+        with mock.patch.object(gss, 'STATUS_QUEUE_SIZE', 3):
+            exchange = gss.StatusExchange()
+            exchange.send_message({'status': 'Syncing', 'n': 0})
+            self.assertTrue(started.wait(5))
+            for n, status in enumerate(
+                    ['Syncing', 'Done', 'Syncing', 'Syncing'], 1):
+                exchange.send_message({'status': status, 'n': n})
+            self.assertEqual([m['n'] for m in exchange._queue], [2, 3, 4])
+            release.set()
+            exchange.close()
+        self.assertEqual([m['n'] for m in self.published], [0, 2, 3, 4])
+
+    def test_other_messages_are_retried(self):
+        self.producer.publish.side_effect = [
+            Exception('broker gone'), Exception('broker gone'), None]
+        exchange = gss.StatusExchange()
+        exchange.send_message({'status': 'Done'})
+        exchange.close()
+        self.assertEqual(self.producer.publish.call_count,
+                         gss.STATUS_PUBLISH_ATTEMPTS)
+        self.sleep.assert_called_with(gss.STATUS_PUBLISH_RETRY_DELAY)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_progress_messages_are_not_retried(self):
+        self.producer.publish.side_effect = Exception('broker gone')
+        exchange = gss.StatusExchange()
+        exchange.send_message({'status': 'Syncing'})
+        exchange.close()
+        self.assertEqual(self.producer.publish.call_count, 1)
+        self.sleep.assert_not_called()
+
+    def test_close_publishes_queued_messages(self):
+        exchange = gss.StatusExchange()
+        for n in range(5):
+            exchange.send_message({'status': 'Syncing', 'n': n})
+        exchange.close()
+        self.assertFalse(exchange._thread.is_alive())
+        self.assertEqual([m['n'] for m in self.published], list(range(5)))
+        self.conn.close.assert_called_once_with()
+
+
+class TestSyncedImageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'state', 'images.sqlite')
+        self.index = gss.SyncedImageIndex(self.path, max_age=3600)
+        self.addCleanup(self.index.close)
+        self.tree = {'products': {}}
+        products_set(self.tree, {'id': 'img1', 'md5': 'abc', 'size': '10'},
+                     ('p1', 'v1', 'disk1.img'))
+
+    def test_load_needs_reconcile(self):
+        self.assertIsNone(self.index.load('auto.sync', 'RegionOne'))
+
+    def test_reconcile_add_remove(self):
+        self.index.reconcile('auto.sync', 'RegionOne', self.tree)
+        self.index.add('auto.sync', 'RegionOne', ('p1', 'v2', 'disk1.img'),
+                       {'id': 'img2'})
+        self.index.remove('auto.sync', 'RegionOne',
+                          ('p1', 'v1', 'disk1.img'))
+        tree = self.index.load('auto.sync', 'RegionOne')
+        self.assertEqual(tree['content_id'], 'auto.sync')
+        self.assertEqual(tree['products']['p1']['versions'],
+                         {'v2': {'items': {'disk1.img': {'id': 'img2'}}}})
+        # Other content ids and regions are indexed separately.
+        self.assertIsNone(self.index.load('auto.sync', 'RegionTwo'))
+
+    def test_index_persists(self):
+        self.index.reconcile('auto.sync', 'RegionOne', self.tree)
+        self.index.close()
+        index = gss.SyncedImageIndex(self.path, max_age=3600)
+        self.addCleanup(index.close)
+        tree = index.load('auto.sync', 'RegionOne')
+        self.assertEqual(
+            tree['products']['p1']['versions']['v1']['items'],
+            {'disk1.img': {'id': 'img1', 'md5': 'abc', 'size': '10'}})
+
+    def test_expired_index_needs_reconcile(self):
+        self.index.reconcile('auto.sync', 'RegionOne', self.tree)
+        with mock.patch.object(gss.time, 'time',
+                               return_value=time.time() + 3601):
+            self.assertIsNone(self.index.load('auto.sync', 'RegionOne'))
+
+    def test_invalidate(self):
+        self.index.reconcile('auto.sync', 'RegionOne', self.tree)
+        self.index.invalidate('auto.sync', 'RegionOne')
+        self.assertIsNone(self.index.load('auto.sync', 'RegionOne'))
+
+    def test_close(self):
+        self.index.close()
+        self.assertRaises(gss.sqlite3.ProgrammingError, self.index.load,
+                          'auto.sync', 'RegionOne')
+
+
+class GlanceError(Exception):
+
+    def __init__(self, code):
+        super(GlanceError, self).__init__('HTTP {}'.format(code))
+        self.code = code
+
+
+class TestPruneImages(unittest.TestCase):
+
+    def setUp(self):
+        sleep = mock.patch.object(gss.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+        self.mirror = gss.GlanceMirrorWithCustomProperties.__new__(
+            gss.GlanceMirrorWithCustomProperties)
+        self.mirror.config = {'content_id': 'auto.sync'}
+        self.mirror.region = 'RegionOne'
+        self.mirror.gclient = mock.MagicMock()
+        self.mirror.image_index = mock.MagicMock()
+        self.mirror.products_ledger = None
+        self.mirror.max_parallel_deletes = 3
+        self.mirror._pending_removals = []
+        self.delete = self.mirror.gclient.images.delete
+
+    def remove(self, *image_ids):
+        target = {'content_id': 'auto.sync', 'products': {}}
+        for image_id in image_ids:
+            pedigree = ('jammy', image_id, 'disk1.img')
+            products_set(target, {'id': image_id}, pedigree)
+            self.mirror.remove_item({'id': image_id, 'size': '10'}, {},
+                                    target, pedigree)
+        self.assertEqual(target['products'], {})
+
+    def unindexed(self):
+        return sorted(call[0][2][1] for call in
+                      self.mirror.image_index.remove.call_args_list)
+
+    def test_images_are_deleted_in_parallel(self):
+        barrier = threading.Barrier(3, timeout=5)
+        self.delete.side_effect = lambda image_id: barrier.wait()
+        self.remove('img1', 'img2', 'img3')
+        # Unpublished right away, deleted only once the new images are in.
+        self.delete.assert_not_called()
+        self.mirror._prune_images()
+        self.assertEqual(sorted(c[0][0] for c in self.delete.call_args_list),
+                         ['img1', 'img2', 'img3'])
+        self.assertEqual(self.unindexed(), ['img1', 'img2', 'img3'])
+        self.assertEqual(self.mirror._pending_removals, [])
+
+    def test_missing_image_counts_as_deleted(self):
+        self.delete.side_effect = GlanceError(404)
+        self.remove('img1')
+        self.mirror._prune_images()
+        self.assertEqual(self.delete.call_count, 1)
+        self.assertEqual(self.unindexed(), ['img1'])
+
+    def test_failed_deletes_are_retried(self):
+        self.delete.side_effect = [GlanceError(503), GlanceError(503), None]
+        self.remove('img1')
+        self.mirror._prune_images()
+        self.assertEqual(self.delete.call_count, gss.IMAGE_DELETE_ATTEMPTS)
+        self.assertEqual(self.sleep.call_args_list,
+                         [mock.call(gss.IMAGE_DELETE_RETRY_DELAY),
+                          mock.call(gss.IMAGE_DELETE_RETRY_DELAY * 2)])
+        self.assertEqual(self.unindexed(), ['img1'])
+
+    def test_images_failing_to_delete_stay_indexed(self):
+        def delete(image_id):
+            if image_id == 'img1':
+                raise GlanceError(500)
+
+        self.delete.side_effect = delete
+        self.remove('img1', 'img2')
+        self.mirror._prune_images()
+        self.assertEqual(self.unindexed(), ['img2'])
+
+
+class TestItemJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'state', 'item-journal.log')
+        self.journal = gss.ItemJournal(self.path)
+        self.addCleanup(self.journal.close)
+
+    def test_unfinished_returns_last_state_of_unfinished_items(self):
+        for pedigree, state in [(('p', 'v', 'a'), 'planned'),
+                                (('p', 'v', 'b'), 'planned'),
+                                (('p', 'v', 'a'), 'downloading'),
+                                (('p', 'v', 'b'), 'uploading'),
+                                (('p', 'v', 'b'), 'active')]:
+            self.journal.record('RegionOne', 'auto.sync', pedigree, state)
+        unfinished = self.journal.unfinished()
+        self.assertEqual(len(unfinished), 1)
+        self.assertEqual(unfinished[0]['pedigree'], ['p', 'v', 'a'])
+        self.assertEqual(unfinished[0]['state'], 'downloading')
+
+    def test_torn_write_is_ignored(self):
+        self.journal.record('RegionOne', 'auto.sync', ('p', 'v', 'a'),
+                            'uploading', image_id='img1')
+        with open(self.path, 'a') as f:
+            f.write('{"region": "RegionOne", "sta')
+        journal = gss.ItemJournal(self.path)
+        self.addCleanup(journal.close)
+        unfinished = journal.unfinished()
+        self.assertEqual([entry['image_id'] for entry in unfinished],
+                         ['img1'])
+
+    def test_reset(self):
+        self.journal.record('RegionOne', 'auto.sync', ('p', 'v', 'a'),
+                            'planned')
+        self.journal.reset()
+        self.assertEqual(self.journal.unfinished(), [])
+        self.journal.record('RegionOne', 'auto.sync', ('p', 'v', 'b'),
+                            'planned')
+        self.assertEqual(len(self.journal.unfinished()), 1)
+
+    def test_close(self):
+        self.journal.close()
+        self.assertRaises(ValueError, self.journal.record, 'RegionOne',
+                          'auto.sync', ('p', 'v', 'a'), 'planned')
+
+
+class ReplayingContentSource(MemoryContentSource):
+    """Like a resumed ResumableContentSource, the first bytes come from
+    a partial file."""
+
+    def __init__(self, content, replay):
+        super(ReplayingContentSource, self).__init__(content=content)
+        self.replay = replay
+        self.replayed = 0
+
+    def read(self, size=-1):
+        buf = super(ReplayingContentSource, self).read(size)
+        self.replayed += min(len(buf), self.replay - self.replayed)
+        return buf
+
+
+class TestDownloadMeter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(gss.time, 'time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.meter = gss.DownloadMeter()
+
+    def test_parallel_downloads_are_timed_once(self):
+        first = gss.MeteredContentSource(
+            MemoryContentSource(content=b'a' * 300), self.meter)
+        second = gss.MeteredContentSource(
+            MemoryContentSource(content=b'b' * 100), self.meter)
+        first.read(100)
+        self.now += 10
+        second.read(100)
+        self.now += 10
+        self.assertEqual(second.read(100), b'')
+        self.now += 10
+        first.read(200)
+        self.assertEqual(first.read(100), b'')
+        # Closed after their end, already accounted for.
+        first.close()
+        second.close()
+        self.now += 100
+        self.assertEqual((self.meter.nbytes, self.meter.seconds), (400, 30))
+
+    def test_closed_download_stops_the_clock(self):
+        source = gss.MeteredContentSource(
+            MemoryContentSource(content=b'a' * 300), self.meter)
+        source.read(100)
+        self.now += 5
+        source.close()
+        self.now += 100
+        self.assertEqual((self.meter.nbytes, self.meter.seconds), (100, 5))
+
+    def test_replayed_bytes_are_not_counted(self):
+        source = gss.MeteredContentSource(
+            ReplayingContentSource(b'x' * 300, replay=150), self.meter)
+        self.assertEqual(len(get_local_copy(source, read_size=100)), 300)
+        source.close()
+        self.assertEqual(self.meter.nbytes, 150)
+
+    def test_blob_cache_hits_are_not_counted(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        blob_cache = gss.BlobCache(tmpdir, max_size=1024)
+        cached_sha256 = hashlib.sha256(b'cached').hexdigest()
+        tmp_path, tmp = blob_cache.create_temp(cached_sha256)
+        with tmp:
+            tmp.write(b'cached')
+        blob_cache.commit(tmp_path, cached_sha256)
+        mirror = gss.GlanceMirrorWithCustomProperties.__new__(
+            gss.GlanceMirrorWithCustomProperties)
+        mirror.blob_cache = blob_cache
+        mirror.mirror_url = 'http://mirror/'
+        mirror.resumable_downloads = False
+        mirror.rate_limiters = []
+        mirror.download_meter = self.meter
+        upstream = mock.MagicMock()
+
+        cached = mirror._item_source(
+            {'sha256': cached_sha256, 'path': 'cached.img'}, upstream)
+        self.assertEqual(get_local_copy(cached), b'cached')
+        cached.close()
+        downloaded = mirror._item_source(
+            {'sha256': hashlib.sha256(b'downloaded').hexdigest(),
+             'path': 'new.img'},
+            MemoryContentSource(content=b'downloaded'))
+        self.assertEqual(get_local_copy(downloaded), b'downloaded')
+        downloaded.close()
+        self.assertEqual(self.meter.nbytes, len(b'downloaded'))
+
+
+class TestPreflightCheck(unittest.TestCase):
+
+    def setUp(self):
+        disk_free = mock.patch.object(gss, 'disk_free', return_value=200)
+        self.disk_free = disk_free.start()
+        self.addCleanup(disk_free.stop)
+        quota = mock.patch.object(gss, 'glance_quota_remaining',
+                                  return_value=None)
+        self.quota = quota.start()
+        self.addCleanup(quota.stop)
+
+    def plans(self, regions, sizes):
+        plans = {}
+        for region in regions:
+            plan = plans[region] = gss.SyncPlan()
+            for name, size in sizes.items():
+                pedigree = ('jammy', 'v1', name)
+                plan.additions.append(('auto.sync', pedigree,
+                                       {'size': str(size)}))
+                plan.items[name] = size
+        return plans
+
+    def check(self, plans, max_parallel_items=1, throughput_history=None,
+              **charm_conf):
+        planners = dict((region, mock.MagicMock()) for region in plans)
+        return gss.preflight_check('http://mirror/', charm_conf,
+                                   max_parallel_items, plans, planners,
+                                   throughput_history)
+
+    def test_largest_staged_images_must_fit(self):
+        plans = self.plans(['RegionOne'], {'a.img': 150, 'b.img': 100})
+        self.assertEqual(self.check(plans), 250)
+        with self.assertRaises(gss.SyncDeferred) as cm:
+            self.check(plans, max_parallel_items=2)
+        self.assertIn('250 bytes of disk needed in {}, 200 free'.format(
+            tempfile.gettempdir()), str(cm.exception))
+        # Streamed images are not staged.
+        self.assertEqual(
+            self.check(plans, max_parallel_items=2, streaming_upload=True),
+            250)
+
+    def test_images_shared_by_regions_are_spooled(self):
+        plans = self.plans(['RegionOne', 'RegionTwo'],
+                           {'a.img': 150, 'b.img': 100})
+        with self.assertRaises(gss.SyncDeferred) as cm:
+            self.check(plans, streaming_upload=True)
+        self.assertIn('250 bytes of disk needed', str(cm.exception))
+        # Each region stages its own copy, on top of the spool.
+        self.disk_free.return_value = 700
+        with self.assertRaises(gss.SyncDeferred) as cm:
+            self.check(plans, max_parallel_items=2)
+        self.assertIn('750 bytes of disk needed', str(cm.exception))
+        self.assertEqual(self.check(plans), 250)
+
+    def test_glance_quota(self):
+        self.quota.return_value = 200
+        plans = self.plans(['RegionOne'], {'a.img': 150, 'b.img': 100})
+        with self.assertRaises(gss.SyncDeferred) as cm:
+            self.check(plans, streaming_upload=True)
+        self.assertIn('250 bytes to upload to glance in RegionOne, its '
+                      'quota allows 200', str(cm.exception))
+
+    def test_max_sync_duration(self):
+        history = mock.MagicMock()
+        history.estimate.return_value = 3600
+        plans = self.plans(['RegionOne'], {'a.img': 150})
+        self.assertEqual(self.check(plans, throughput_history=history,
+                                    streaming_upload=True,
+                                    max_sync_duration=60), 150)
+        with self.assertRaises(gss.SyncDeferred) as cm:
+            self.check(plans, throughput_history=history,
+                       streaming_upload=True, max_sync_duration=30)
+        self.assertIn('estimated to take 60 minutes', str(cm.exception))
+        history.estimate.assert_called_with(150)
+
+
+class TestRecoverInterruptedItems(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.journal = gss.ItemJournal(os.path.join(self.tmpdir, 'journal'))
+        self.addCleanup(self.journal.close)
+        self.index = gss.SyncedImageIndex(
+            os.path.join(self.tmpdir, 'images.sqlite'), max_age=3600)
+        self.addCleanup(self.index.close)
+        self.index.reconcile('auto.sync', 'RegionOne', {'products': {}})
+        self.gclient = mock.MagicMock()
+        self.keystone_session = mock.MagicMock()
+        self.keystone_session.get_glanceclient.return_value = self.gclient
+
+    def test_complete_image_is_kept_and_index_invalidated(self):
+        self.journal.record('RegionOne', 'auto.sync', ('p', 'v', 'i'),
+                            'uploading', image_id='img1', md5='abc',
+                            size=10)
+        self.gclient.images.get.return_value = {
+            'status': 'active', 'checksum': 'abc', 'size': 10}
+        gss.recover_interrupted_items(self.journal, self.keystone_session,
+                                      image_index=self.index)
+        self.gclient.images.delete.assert_not_called()
+        self.assertIsNone(self.index.load('auto.sync', 'RegionOne'))
+        self.assertEqual(self.journal.unfinished(), [])
+
+    def test_incomplete_image_is_deleted(self):
+        self.journal.record('RegionOne', 'auto.sync', ('p', 'v', 'i'),
+                            'uploading', image_id='img1', md5='abc',
+                            size=10)
+        self.gclient.images.get.return_value = {
+            'status': 'saving', 'checksum': None, 'size': None}
+        gss.recover_interrupted_items(self.journal, self.keystone_session,
+                                      image_index=self.index)
+        self.gclient.images.delete.assert_called_once_with('img1')
+        self.assertIsNotNone(self.index.load('auto.sync', 'RegionOne'))
+
+
+class TestJujuState(unittest.TestCase):
+
+    def setUp(self):
+        gss._juju_state.clear()
+        self.addCleanup(gss._juju_state.clear)
+
+    @mock.patch.object(gss, 'juju_run_cmd')
+    def test_status_set_skips_unchanged_status(self, juju_run_cmd):
+        gss.status_set('active', 'ready')
+        gss.status_set('active', 'ready')
+        gss.status_set('blocked', 'broken')
+        self.assertEqual(juju_run_cmd.call_count, 2)
+
+    @mock.patch.object(gss, 'juju_run_cmd')
+    def test_status_set_retries_after_failure(self, juju_run_cmd):
+        juju_run_cmd.side_effect = [
+            gss.subprocess.CalledProcessError(1, 'juju-run'), b'']
+        gss.status_set('active', 'ready')
+        gss.status_set('active', 'ready')
+        self.assertEqual(juju_run_cmd.call_count, 2)
+
+    def test_status_set_from_juju_run_cmd_does_not_deadlock(self):
+        # get_conf() reports a broken configuration with status_set().
+        def juju_run_cmd(cmd):
+            gss.status_set('blocked', 'bad config')
+            raise SystemExit(1)
+
+        def set_status():
+            with mock.patch.object(gss, 'juju_run_cmd', juju_run_cmd):
+                try:
+                    gss.status_set('blocked', 'bad config')
+                except SystemExit:
+                    pass
+
+        thread = threading.Thread(target=set_status, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertNotIn('status', gss._juju_state)
+
+    @mock.patch.object(gss, 'juju_run_cmd')
+    def test_update_endpoint_urls_runs_every_time(self, juju_run_cmd):
+        for _ in range(2):
+            gss.update_endpoint_urls('RegionOne', 'http://pub',
+                                     'http://admin', 'http://int')
+        self.assertEqual(juju_run_cmd.call_count, 2)
+        cmd = ' '.join(juju_run_cmd.call_args[0][0])
+        self.assertIn('relation-ids identity-service', cmd)
+        self.assertIn('public_url=http://pub', cmd)
+
+
+class TestRunDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.conf = os.path.join(self.tmpdir, 'mirrors.yaml')
+        with open(self.conf, 'w') as f:
+            f.write('frequency: weekly\n')
+        for name, value in (
+                ('ID_CONF_FILE_NAME', os.path.join(self.tmpdir, 'missing')),
+                ('CHARM_CONF_FILE_NAME', self.conf),
+                ('CONF_POLL_INTERVAL', 0.05)):
+            patcher = mock.patch.object(gss, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.stop = threading.Event()
+
+    def wait_in_thread(self, delay):
+        thread = threading.Thread(target=gss.wait_for_next_sync,
+                                  args=(self.stop, delay), daemon=True)
+        thread.start()
+        return thread
+
+    def test_wait_ends_when_the_configuration_changes(self):
+        thread = self.wait_in_thread(3600)
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+        with open(self.conf, 'w') as f:
+            f.write('frequency: hourly\n')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_wait_ends_when_stopped(self):
+        thread = self.wait_in_thread(3600)
+        self.stop.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_wait_ends_after_delay(self):
+        thread = self.wait_in_thread(0.2)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    @mock.patch.object(gss, 'get_keystone_client')
+    @mock.patch.object(gss, 'KeystoneSession')
+    @mock.patch.object(gss, 'set_openstack_env')
+    @mock.patch.object(gss, 'get_conf')
+    @mock.patch.object(gss, 'run_sync')
+    @mock.patch.object(gss, 'wait_for_next_sync')
+    def test_sync_frequency_and_backoff(self, wait_for_next_sync, run_sync,
+                                        get_conf, set_openstack_env,
+                                        keystone_session,
+                                        get_keystone_client):
+        get_conf.return_value = ({'api_version': 3},
+                                 {'frequency': 'hourly',
+                                  'region': 'RegionOne'})
+        run_sync.side_effect = [False, False, True, False]
+        delays = []
+
+        def wait(stop, delay):
+            delays.append(delay)
+            if len(delays) == 4:
+                stop.set()
+
+        wait_for_next_sync.side_effect = wait
+        gss.run_daemon(self.stop)
+        self.assertEqual(delays, [gss.READINESS_BACKOFF_MIN,
+                                  2 * gss.READINESS_BACKOFF_MIN,
+                                  gss.SYNC_INTERVALS['hourly'],
+                                  gss.READINESS_BACKOFF_MIN])
+        # The keystone session is kept while identity.yaml is unchanged.
+        self.assertEqual(keystone_session.call_count, 1)
+
+
+class TestImageStream(unittest.TestCase):
+
+    def setUp(self):
+        timeout = mock.patch.object(gss, 'HTTP_TIMEOUT', 5)
+        timeout.start()
+        self.addCleanup(timeout.stop)
+        self.source = MemoryContentSource(content=b'x' * (3 * 1024 * 1024))
+        self.source.close = mock.MagicMock()
+
+    def test_upload_reads_verified_image(self):
+        stream = gss.ImageStream(gss.StreamingVerifier(
+            self.source, size=3 * 1024 * 1024))
+        with open(stream.path, 'rb') as f:
+            self.assertEqual(len(f.read()), 3 * 1024 * 1024)
+        # Like GlanceMirror.insert_item() does once it uploaded the image.
+        os.unlink(stream.path)
+        self.assertIsNone(stream.finish())
+        self.source.close.assert_called_once_with()
+        self.assertFalse(os.path.exists(stream.tmp_dir))
+
+    def test_finish_without_upload_stops_writer(self):
+        stream = gss.ImageStream(gss.StreamingVerifier(self.source))
+        stream.finish()
+        self.assertFalse(stream.thread.is_alive())
+        self.source.close.assert_called_once_with()
+        self.assertFalse(os.path.exists(stream.tmp_dir))
+
+    def test_finish_before_writer_opens_pipe(self):
+        def slow_open(*args, **kwargs):
+            # The writer only gets to open the pipe once finish() started.
+            time.sleep(0.5)
+            return open(*args, **kwargs)
+
+        with mock.patch.object(gss, 'open', slow_open, create=True):
+            stream = gss.ImageStream(gss.StreamingVerifier(self.source))
+            stream.finish()
+        self.assertFalse(stream.thread.is_alive())
+        self.source.close.assert_called_once_with()
+
+
+class TestImageConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.image = os.path.join(self.tmpdir, 'disk1.img')
+        with open(self.image, 'wb') as f:
+            f.write(b'qcow2')
+
+    def qemu_img(self, source_format):
+        def check_output(cmd):
+            return json.dumps({'format': source_format}).encode('utf-8')
+
+        def check_call(cmd):
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'raw image')
+        return (mock.patch.object(gss.subprocess, 'check_output',
+                                  check_output),
+                mock.patch.object(gss.subprocess, 'check_call', check_call))
+
+    def test_convert_image_checksums_converted_file(self):
+        info, convert = self.qemu_img('qcow2')
+        with info, convert:
+            path, checksums = gss.convert_image(self.image, 'raw',
+                                                scratch_dir=self.tmpdir)
+        self.assertEqual(checksums, {
+            'size': '9',
+            'md5': hashlib.md5(b'raw image').hexdigest(),
+            'sha256': hashlib.sha256(b'raw image').hexdigest()})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'raw image')
+
+    def test_convert_image_leaves_raw_images(self):
+        info, convert = self.qemu_img('raw')
+        with info, convert:
+            self.assertIsNone(gss.convert_image(self.image, 'raw'))
+
+    def test_converted_checksums_replace_the_upstream_ones(self):
+        mirror = gss.GlanceMirrorWithCustomProperties.__new__(
+            gss.GlanceMirrorWithCustomProperties)
+        mirror._local = threading.local()
+        mirror.disk_format = 'raw'
+        mirror.image_converter = mock.MagicMock()
+        checksums = {'size': '9', 'md5': 'converted-md5',
+                     'sha256': 'converted-sha256'}
+        mirror.image_converter.convert.return_value = ('/tmp/converted',
+                                                       checksums)
+        mirror._local.journal_item = (('p', 'v', 'i'), {
+            'md5': 'upstream-md5', 'sha256': 'upstream-sha256',
+            'sha512': 'upstream-sha512', 'size': '5', 'ftype': 'disk1.img'})
+
+        self.assertEqual(mirror._convert_image(
+            (self.image, 5, 'upstream-md5'), {'pubname': 'disk1.img'}),
+            ('/tmp/converted', 9, 'converted-md5'))
+        self.assertFalse(os.path.exists(self.image))
+        # What the item journal records once the glance image exists.
+        self.assertEqual(mirror._local.journal_item[1],
+                         dict(checksums, ftype='disk1.img'))
+
+
+class TestBandwidthSchedule(unittest.TestCase):
+
+    def test_parse_bandwidth_schedule(self):
+        self.assertEqual(
+            gss.parse_bandwidth_schedule('01:00-05:30=0, 22:00-02:00=20'),
+            [(60, 330, 0.0), (1320, 120, 20.0)])
+        self.assertEqual(gss.parse_bandwidth_schedule(''), [])
+
+    def test_parse_bandwidth_schedule_rejects_invalid_windows(self):
+        for schedule in ('01:00=5', '1-5=5', '01:00-05:00'):
+            self.assertRaises(ValueError, gss.parse_bandwidth_schedule,
+                              schedule)
+
+    def rate_at(self, hour, minute, limit, windows):
+        now = time.struct_time((2024, 1, 1, hour, minute, 0, 0, 1, 0))
+        with mock.patch.object(gss.time, 'localtime', return_value=now):
+            return gss.bandwidth_rate(limit, windows)()
+
+    def test_bandwidth_rate(self):
+        windows = gss.parse_bandwidth_schedule('22:00-02:00=0 12:00-13:00=8')
+        self.assertEqual(self.rate_at(10, 0, 80, windows), 10 * 1000 * 1000)
+        self.assertEqual(self.rate_at(12, 30, 80, windows), 1000 * 1000)
+        # Windows spanning midnight, 0 lifts the limit.
+        self.assertIsNone(self.rate_at(23, 0, 80, windows))
+        self.assertIsNone(self.rate_at(1, 59, 80, windows))
+        self.assertEqual(self.rate_at(2, 0, 80, windows), 10 * 1000 * 1000)
+        self.assertIsNone(self.rate_at(10, 0, 0, ()))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(gss.time, 'time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        sleep = mock.patch.object(gss.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_consume_sleeps_off_the_deficit(self):
+        bucket = gss.TokenBucket(lambda: 100)
+        bucket.consume(50)
+        self.sleep.assert_called_once_with(0.5)
+
+    def test_tokens_refill_up_to_the_burst(self):
+        bucket = gss.TokenBucket(lambda: 100)
+        self.now += 10
+        bucket.consume(100)
+        self.sleep.assert_not_called()
+        bucket.consume(100)
+        self.sleep.assert_called_once_with(1.0)
+
+    def test_no_limit(self):
+        bucket = gss.TokenBucket(lambda: None)
+        bucket.consume(10 ** 9)
+        self.sleep.assert_not_called()
+
+
+class TestSyncPriority(unittest.TestCase):
+
+    ITEMS = [
+        {'name': 'focal-arm64', 'version': '20.04', 'arch': 'arm64',
+         'release_title': '20.04 LTS', 'size': '300'},
+        {'name': 'mantic-amd64', 'version': '23.10', 'arch': 'amd64',
+         'release_title': '23.10', 'size': '200'},
+        {'name': 'jammy-amd64', 'version': '22.04', 'arch': 'amd64',
+         'release_title': '22.04 LTS', 'size': '400'},
+        {'name': 'jammy-arm64', 'version': '22.04', 'arch': 'arm64',
+         'release_title': '22.04 LTS', 'size': '100'},
+    ]
+
+    def sorted_names(self, rules):
+        entries = list(self.ITEMS)
+        gss.sort_by_priority(entries, gss.parse_priority_rules(rules),
+                             lambda entry: entry)
+        return [entry['name'] for entry in entries]
+
+    def test_release(self):
+        self.assertEqual(self.sorted_names('release'),
+                         ['mantic-amd64', 'jammy-amd64', 'jammy-arm64',
+                          'focal-arm64'])
+
+    def test_rules_apply_most_significant_first(self):
+        self.assertEqual(self.sorted_names('lts, arch=amd64 size'),
+                         ['jammy-amd64', 'jammy-arm64', 'focal-arm64',
+                          'mantic-amd64'])
+
+    def test_no_rules_keep_the_stream_order(self):
+        self.assertEqual(self.sorted_names(''),
+                         [item['name'] for item in self.ITEMS])
+
+    def test_unknown_rule(self):
+        self.assertRaises(ValueError, gss.parse_priority_rules, 'oldest')
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_atomic_write(self):
+        path = os.path.join(self.tmpdir, 'state', 'auth-state.json')
+        gss.atomic_write(path, '{"state": 1}', mode=0o600)
+        gss.atomic_write(path, b'{"state": 2}', mode=0o600)
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'state': 2})
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         ['auth-state.json'])
+
+    def test_throughput_history_persists(self):
+        path = os.path.join(self.tmpdir, 'state', 'throughput.json')
+        history = gss.ThroughputHistory(path)
+        self.assertIsNone(history.estimate(100))
+        history.record(1000, 10)
+        self.assertEqual(gss.ThroughputHistory(path).estimate(1000), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()